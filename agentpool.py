@@ -0,0 +1,185 @@
+#!/usr/bin/python
+
+"""
+Runs the agents in worker processes, so each round's requests() and
+uploads() calls happen in parallel.
+
+The agents live in the workers for the whole run: worker k builds every
+k-th peer (in peers order) and keeps its own History with those peers'
+messages, so agents see exactly what they would in the sim's process.
+Each round the sim sends every worker what its agents need (the peer
+info, availability, their pieces and the last round's messages) and gets
+back their requests, then their uploads.  The sim still validates
+everything and merges the results in peers order.  With a tracker, the
+workers also get their peers' neighbor lists whenever those change.
+"""
+
+import multiprocessing
+import random
+import time
+import traceback
+import types
+
+from history import History
+from swarm import PiecesView
+from util import derive_seed
+
+
+class WorkerError(Exception):
+    """An agent raised in a worker.  The message is the worker's traceback."""
+    pass
+
+
+def worker_main(conn, conf, specs, peer_ids, upload_rates, seed):
+    """Serve one share of the agents until told to stop.
+    specs: (class name, peer id, pieces, up bw, random stream) for each of
+    this worker's peers."""
+    try:
+        # Agents draw from their own streams; this is for any that still
+        # use the random module
+        random.seed(seed)
+        peers = [conf.agent_classes[name](conf, id, pieces, up_bw, rng)
+                 for (name, id, pieces, up_bw, rng) in specs]
+        history = History(peer_ids, upload_rates)
+        nothing = dict((pid, []) for pid in peer_ids)
+        neighbors = None  # peer id -> neighbor ids, with a tracker
+        clock = time.perf_counter
+
+        def visible_to(peer_id):
+            if neighbors is None:
+                return [info for info in peer_info if info.id != peer_id]
+            return [info_by_id[n] for n in neighbors[peer_id]]
+    except Exception:
+        conn.send(("error", traceback.format_exc()))
+        return
+    conn.send(("ready", None))
+
+    while True:
+        msg = conn.recv()
+        try:
+            if msg[0] == "requests":
+                (kind, last_round, peer_info, availability, pieces,
+                 new_neighbors) = msg
+                if last_round is not None:
+                    (dls, ups) = last_round
+                    history.update(dict(nothing, **dls), dict(nothing, **ups))
+                if new_neighbors is not None:
+                    neighbors = new_neighbors
+                if neighbors is not None:
+                    info_by_id = dict((info.id, info) for info in peer_info)
+                availability = types.MappingProxyType(availability)
+                result = []
+                for p in peers:
+                    if p.id not in pieces:
+                        continue  # not active this round
+                    others = visible_to(p.id)
+                    p.update_pieces(PiecesView(pieces[p.id]))
+                    p.update_availability(availability)
+                    start = clock()
+                    rs = p.requests(others, history.peer_history(p.id))
+                    result.append((p.id, rs, clock() - start))
+            elif msg[0] == "uploads":
+                # peer_info is still the round's, from the requests message
+                (kind, requests_to) = msg
+                result = []
+                for p in peers:
+                    if p.id not in requests_to:
+                        continue  # not active this round
+                    others = visible_to(p.id)
+                    start = clock()
+                    us = p.uploads(requests_to[p.id], others,
+                                   history.peer_history(p.id))
+                    result.append((p.id, us, clock() - start))
+            else:
+                return
+        except Exception:
+            conn.send(("error", traceback.format_exc()))
+            return
+        conn.send(("ok", result))
+
+
+class AgentPool:
+    def __init__(self, conf, specs, upload_rates, workers, seed=None):
+        """specs: (class name, peer id, pieces, up bw, random stream), in
+        peers order.  Worker k's random module is seeded from seed and k."""
+        peer_ids = [spec[1] for spec in specs]
+        self.shares = []  # per worker: its peer ids
+        self.conns = []
+        self.procs = []
+        self.last_round = None
+        for k in range(workers):
+            share = specs[k::workers]
+            worker_seed = None
+            if seed is not None:
+                worker_seed = derive_seed(seed, "decision-worker", k)
+            (conn, child) = multiprocessing.Pipe()
+            proc = multiprocessing.Process(
+                target=worker_main,
+                args=(child, conf, share, peer_ids, upload_rates, worker_seed))
+            proc.daemon = True
+            proc.start()
+            self.shares.append([spec[1] for spec in share])
+            self.conns.append(conn)
+            self.procs.append(proc)
+        self.gather()
+
+    def gather(self):
+        """Every worker's reply, in worker order"""
+        replies = []
+        for conn in self.conns:
+            (status, result) = conn.recv()
+            if status == "error":
+                self.close()
+                raise WorkerError(result)
+            replies.append(result)
+        return replies
+
+    def merge(self, replies):
+        """peer id -> (messages, seconds the call took)"""
+        out = dict()
+        for reply in replies:
+            for (pid, msgs, seconds) in reply:
+                out[pid] = (msgs, seconds)
+        return out
+
+    def requests(self, peer_info, availability, pieces, neighbors=None):
+        """pieces: peer id -> list of block counts, for just the peers to
+        call.  neighbors: peer id -> neighbor ids, when the tracker has
+        drawn new ones.  Returns their requests."""
+        for (conn, share) in zip(self.conns, self.shares):
+            last_round = None
+            if self.last_round is not None:
+                (dls, ups) = self.last_round
+                last_round = (dict((pid, dls[pid]) for pid in share),
+                              dict((pid, ups[pid]) for pid in share))
+            share_neighbors = None
+            if neighbors is not None:
+                share_neighbors = dict((pid, neighbors[pid]) for pid in share)
+            conn.send(("requests", last_round, peer_info, availability,
+                       dict((pid, pieces[pid]) for pid in share
+                            if pid in pieces),
+                       share_neighbors))
+        return self.merge(self.gather())
+
+    def uploads(self, requests_to):
+        """requests_to: peer id -> the requests made to it this round, for
+        just the peers to call.  Returns their uploads."""
+        for (conn, share) in zip(self.conns, self.shares):
+            conn.send(("uploads", dict((pid, requests_to[pid]) for pid in share
+                                       if pid in requests_to)))
+        return self.merge(self.gather())
+
+    def update(self, downloads, uploads):
+        """The round's messages.  Sent along with the next round's request."""
+        self.last_round = (downloads, uploads)
+
+    def close(self):
+        for conn in self.conns:
+            try:
+                conn.send(("stop",))
+            except (OSError, ValueError):
+                pass
+        for proc in self.procs:
+            proc.join(1)
+            if proc.is_alive():
+                proc.terminate()
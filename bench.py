@@ -0,0 +1,355 @@
+#!/usr/bin/env python
+
+"""
+Benchmarks the sim core over a matrix of swarm sizes, piece counts,
+blocks per piece and agent mixes.
+
+  bench.py run [options]              run the matrix, write results JSON
+  bench.py compare BASELINE RESULTS   flag cases that got slower or bigger
+  bench.py engines [options]          check the engines agree on random rounds
+
+Each case runs a fixed number of rounds (--rounds; agents that finish
+early end the run early) with all logging off.  For each case it records
+rounds/sec (best of --repeat runs), the time spent in each phase of the
+round loop in that run, and the peak memory traced while running it once
+more under tracemalloc.  With --neighbors every case runs with a tracker
+giving each peer that many neighbors, as sim.py --neighbors does.
+EXTRA_CASES, such as a 4096-piece swarm, run after the matrix unless
+--no-extra is given.
+
+compare exits with status 1 if any case present in both files ran
+slower, or peaked higher, than the baseline by more than --threshold.
+
+engines runs --trials random swarms (random sizes, piece counts and
+blocks per piece) for up to --rounds rounds of random valid requests and
+uploads through every engine's apply_round, and exits with status 1 if
+any engine's downloads or state differ from the dict engine's.
+"""
+
+import itertools
+import json
+import logging
+import platform
+import sys
+import time
+import tracemalloc
+from optparse import OptionParser
+
+from messages import Request, Upload
+from sim import ENGINES, Sim, configure_logging, default_options, make_config
+from swarm import make_swarm_state, upload_rate_table
+from timing import PhaseTimer
+from util import Params, derive_seed, seeded_rng
+
+# Agent mixes: the non-seed agents of a swarm, handed out round-robin
+MIXES = {
+    "dummy": ["Dummy"],
+    "std": ["MaxncodyStd"],
+    "tyrant": ["MaxncodyTyrant"],
+    "mixed": ["MaxncodyStd", "MaxncodyTyrant", "MaxncodyTourney",
+              "MaxncodyPropShare"],
+}
+
+# One seed per this many peers (at least one)
+PEERS_PER_SEED = 10
+
+# Cases run on top of the matrix (unless --no-extra), for shapes it doesn't
+# cover.  A case's "rounds" overrides --rounds.
+EXTRA_CASES = [
+    # Many pieces: the agents' per-piece work and PieceSet dominate
+    dict(size=23, pieces=4096, bpp=4, mix="std", rounds=5),
+]
+
+
+def int_list(s):
+    return [int(x) for x in s.split(",")]
+
+
+def swarm_agents(size, mix):
+    """The agent class names for a swarm of size peers"""
+    seeds = max(1, size // PEERS_PER_SEED)
+    others = itertools.islice(itertools.cycle(MIXES[mix]), size - seeds)
+    return ["Seed"] * seeds + list(others)
+
+
+def case_name(case):
+    return "peers=%(size)d pieces=%(pieces)d bpp=%(bpp)d mix=%(mix)s" % case
+
+
+def make_cases(sizes, pieces, bpps, mixes):
+    return [dict(size=n, pieces=p, bpp=b, mix=m)
+            for (n, p, b, m) in itertools.product(sizes, pieces, bpps, mixes)]
+
+
+def case_config(case, rounds, engine, neighbors=0):
+    options = default_options()
+    options.num_pieces = case["pieces"]
+    options.blocks_per_piece = case["bpp"]
+    options.max_round = rounds
+    options.engine = engine
+    options.neighbors = neighbors
+    options.quiet = True
+    return make_config(swarm_agents(case["size"], case["mix"]), options)
+
+
+def run_case(case, rounds, engine, repeat, seed, memory=True, neighbors=0):
+    """Benchmark one case.  Returns its result dict."""
+    rounds = case.get("rounds", rounds)
+    config = case_config(case, rounds, engine, neighbors)
+    run_seed = derive_seed(seed, case_name(case))
+
+    best = None
+    for i in range(repeat):
+        timer = PhaseTimer()
+        start = time.perf_counter()
+        Sim(config).run_sim_once(run_seed, timer)
+        seconds = time.perf_counter() - start
+        if best is None or seconds < best[0]:
+            best = (seconds, timer)
+    (seconds, timer) = best
+
+    result = dict(case,
+                  rounds=timer.rounds,
+                  seconds=seconds,
+                  rounds_per_sec=timer.rounds / seconds,
+                  phases=timer.totals)
+    if memory:
+        tracemalloc.start()
+        try:
+            Sim(config).run_sim_once(run_seed)
+            result["peak_bytes"] = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return result
+
+
+def run_bench(cases, rounds, engine, repeat, seed, memory=True, neighbors=0):
+    results = dict()
+    for case in cases:
+        name = case_name(case)
+        r = run_case(case, rounds, engine, repeat, seed, memory, neighbors)
+        logging.warning("%-45s %6d rounds  %9.1f rounds/s%s" % (
+            name, r["rounds"], r["rounds_per_sec"],
+            "  %7.1f MB peak" % (r["peak_bytes"] / 2.0 ** 20) if memory else ""))
+        results[name] = r
+    return dict(meta=dict(python=platform.python_version(),
+                          platform=platform.platform(),
+                          engine=engine, neighbors=neighbors,
+                          rounds=rounds, repeat=repeat,
+                          seed=seed, time=time.strftime("%Y-%m-%d %H:%M:%S")),
+                cases=results)
+
+
+def compare(baseline, results, threshold):
+    """Log each case in both, and return the names of the cases that
+    regressed by more than threshold (a fraction)"""
+    regressed = []
+    base_cases = baseline["cases"]
+    for (name, r) in sorted(results["cases"].items()):
+        b = base_cases.get(name)
+        if b is None:
+            continue
+        speed = r["rounds_per_sec"] / b["rounds_per_sec"]
+        flags = []
+        if speed < 1 - threshold:
+            flags.append("SLOWER")
+        mem = ""
+        if "peak_bytes" in r and "peak_bytes" in b:
+            growth = r["peak_bytes"] / float(b["peak_bytes"])
+            mem = "  mem x%.2f" % growth
+            if growth > 1 + threshold:
+                flags.append("BIGGER")
+        logging.warning("%-45s speed x%.2f%s  %s" % (name, speed, mem,
+                                                    " ".join(flags)))
+        if flags:
+            regressed.append(name)
+    return regressed
+
+
+def random_round(state, rng):
+    """A round of valid requests and uploads for state: each unfinished
+    peer asks random peers for random pieces they have and it still needs,
+    and each peer uploads random amounts to a few of the peers asking it.
+    Returns (requests, rates) as apply_round takes them."""
+    conf = state.conf
+    ids = state.peer_ids
+    requests = dict()
+    asking = dict((pid, []) for pid in ids)  # uploader -> requester ids
+    for pid in ids:
+        requests[pid] = rs = []
+        if state.peer_done(pid):
+            continue
+        for i in range(rng.randrange(2 * conf.num_pieces + 1)):
+            (peer_id, piece_id) = (rng.choice(ids), rng.randrange(conf.num_pieces))
+            start = state.blocks(pid, piece_id)
+            if (peer_id == pid or start >= conf.blocks_per_piece
+                    or not state.available_map[peer_id][piece_id]):
+                continue
+            rs.append(Request(pid, peer_id, piece_id, start))
+            asking[peer_id].append(pid)
+    uploads = dict()
+    for pid in ids:
+        who = list(dict.fromkeys(asking[pid]))
+        who = rng.sample(who, min(len(who), rng.randrange(1, 5)))
+        # Sometimes two uploads to one peer, which add up
+        uploads[pid] = [Upload(pid, to_id, rng.randrange(1, 2 * conf.blocks_per_piece))
+                        for to_id in who + who[:rng.randrange(2)]]
+    return (requests, upload_rate_table(uploads))
+
+
+def engine_snapshot(state, downloads):
+    """What a round left behind, in a form that compares across engines"""
+    return (sorted((pid, list(ds)) for (pid, ds) in downloads.items()),
+            [list(state.pieces(pid)) for pid in state.peer_ids],
+            [sorted(state.available[pid]) for pid in state.peer_ids],
+            sorted(state.availability.items()),
+            sorted(state.completed.items()),
+            state.newly_done())
+
+
+def check_engines(trials, rounds, seed):
+    """Run the same random rounds through every engine.  Returns the
+    (trial, round, engine) of each engine that first differed from the
+    dict engine in a trial."""
+    mismatches = []
+    for trial in range(trials):
+        shape = seeded_rng(seed, "engines", trial)
+        (pieces, bpp) = (shape.randrange(1, 60), shape.randrange(1, 17))
+        size = shape.randrange(2, 40)
+        seeds = shape.randrange(1, 4)
+        ids = (["Seed%d" % i for i in range(seeds)] +
+               ["Peer%d" % i for i in range(size - seeds)])
+
+        runs = dict()
+        for engine in ENGINES:
+            conf = Params()
+            conf.add("num_pieces", pieces)
+            conf.add("blocks_per_piece", bpp)
+            conf.add("engine", engine)
+            state = make_swarm_state(conf, ids)
+            rng = seeded_rng(seed, "engines", trial, "rounds")
+            snapshots = [engine_snapshot(state, dict())]
+            for r in range(rounds):
+                if state.all_done():
+                    break
+                (requests, rates) = random_round(state, rng)
+                downloads = state.apply_round(requests, rates)
+                snapshots.append(engine_snapshot(state, downloads))
+            runs[engine] = snapshots
+
+        for engine in ENGINES[1:]:
+            for (r, (a, b)) in enumerate(zip(runs["dict"], runs[engine])):
+                if a != b:
+                    mismatches.append((trial, r, engine))
+                    break
+            else:
+                if len(runs["dict"]) != len(runs[engine]):
+                    mismatches.append((trial, None, engine))
+    return mismatches
+
+
+def main(args):
+    usage_msg = ("Usage:  %prog run [options]\n        %prog compare BASELINE RESULTS"
+                 "\n        %prog engines [options]")
+    parser = OptionParser(usage=usage_msg)
+
+    parser.add_option("--sizes",
+                      dest="sizes", default="10,50,200",
+                      help="Swarm sizes, comma separated")
+
+    parser.add_option("--pieces",
+                      dest="pieces", default="32,128",
+                      help="Piece counts, comma separated")
+
+    parser.add_option("--blocks-per-piece",
+                      dest="bpps", default="4,16",
+                      help="Blocks per piece, comma separated")
+
+    parser.add_option("--mixes",
+                      dest="mixes", default="dummy,std,mixed",
+                      help="Agent mixes, comma separated, from: %s" % ", ".join(sorted(MIXES)))
+
+    parser.add_option("--rounds",
+                      dest="rounds", default=100, type="int",
+                      help="Rounds per run (at most)")
+
+    parser.add_option("--repeat",
+                      dest="repeat", default=3, type="int",
+                      help="Runs per case; the fastest counts")
+
+    parser.add_option("--engine",
+                      dest="engine", default="dict", choices=ENGINES,
+                      help="Swarm state engine, as for sim.py")
+
+    parser.add_option("--neighbors",
+                      dest="neighbors", default=0, type="int",
+                      help="Neighbors per peer, as for sim.py (0, the default, means everyone)")
+
+    parser.add_option("--seed",
+                      dest="seed", default=0, type="int",
+                      help="Base seed; each case derives its own")
+
+    parser.add_option("--no-extra",
+                      dest="extra", default=True, action="store_false",
+                      help="Only run the matrix, not the extra cases")
+
+    parser.add_option("--no-memory",
+                      dest="memory", default=True, action="store_false",
+                      help="Skip the tracemalloc run that measures peak memory")
+
+    parser.add_option("--out",
+                      dest="out", default="bench.json",
+                      help="Where 'run' writes its results")
+
+    parser.add_option("--threshold",
+                      dest="threshold", default=0.10, type="float",
+                      help="For 'compare': the slowdown or memory growth (a fraction) that counts as a regression")
+
+    parser.add_option("--trials",
+                      dest="trials", default=200, type="int",
+                      help="For 'engines': random swarms to run through every engine")
+
+    (options, args) = parser.parse_args(args[1:])
+    configure_logging("warning")
+
+    if args[:1] == ["run"] and len(args) == 1:
+        mixes = options.mixes.split(",")
+        for m in mixes:
+            if m not in MIXES:
+                parser.error("Unknown mix: %s" % m)
+        cases = make_cases(int_list(options.sizes), int_list(options.pieces),
+                           int_list(options.bpps), mixes)
+        if options.extra:
+            names = set(map(case_name, cases))
+            cases += [c for c in EXTRA_CASES if case_name(c) not in names]
+        results = run_bench(cases, options.rounds, options.engine,
+                            options.repeat, options.seed, options.memory,
+                            options.neighbors)
+        with open(options.out, "w") as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+        logging.warning("Results written to %s" % options.out)
+    elif args[:1] == ["compare"] and len(args) == 3:
+        with open(args[1]) as f:
+            baseline = json.load(f)
+        with open(args[2]) as f:
+            results = json.load(f)
+        regressed = compare(baseline, results, options.threshold)
+        if regressed:
+            logging.warning("%d regression(s)" % len(regressed))
+            sys.exit(1)
+    elif args[:1] == ["engines"] and len(args) == 1:
+        mismatches = check_engines(options.trials, options.rounds, options.seed)
+        for (trial, r, engine) in mismatches:
+            logging.warning("trial %d: %s engine differs from dict %s" % (
+                trial, engine,
+                "in round %d" % r if r is not None else "in run length"))
+        if mismatches:
+            sys.exit(1)
+        logging.warning("%d trials: all engines agree" % options.trials)
+    else:
+        parser.print_help()
+        sys.exit(2)
+
+
+if __name__ == "__main__":
+    main(sys.argv)
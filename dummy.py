@@ -6,10 +6,10 @@
 # You'll want to copy this file to AgentNameXXX.py for various versions of XXX,
 # probably get rid of the silly logging messages, and then add more logic.
 
-import random
 import logging
 
 from messages import Upload, Request
+from pieceset import PieceSet
 from util import even_split
 from peer import Peer
 
@@ -30,23 +30,25 @@ class Dummy(Peer):
         """
         needed = lambda i: self.pieces[i] < self.conf.blocks_per_piece
         needed_pieces = list(filter(needed, list(range(len(self.pieces)))))
-        np_set = set(needed_pieces)  # sets support fast intersection ops.
+        np_set = PieceSet(needed_pieces)  # bitsets make intersections cheap.
 
 
-        logging.debug("%s here: still need pieces %s" % (
-            self.id, needed_pieces))
+        # Pass logging the arguments rather than a formatted string, so
+        # nothing gets formatted unless debug logging is on.
+        logging.debug("%s here: still need pieces %s",
+            self.id, needed_pieces)
 
-        logging.debug("%s still here. Here are some peers:" % self.id)
+        logging.debug("%s still here. Here are some peers:", self.id)
         for p in peers:
-            logging.debug("id: %s, available pieces: %s" % (p.id, p.available_pieces))
+            logging.debug("id: %s, available pieces: %s", p.id, p.available_pieces)
 
         logging.debug("And look, I have my entire history available too:")
         logging.debug("look at the AgentHistory class in history.py for details")
-        logging.debug(str(history))
+        logging.debug("%s", history)
 
         requests = []   # We'll put all the things we want here
         # Symmetry breaking is good...
-        random.shuffle(needed_pieces)
+        self.rng.shuffle(needed_pieces)
         
         # Sort peers by id.  This is probably not a useful sort, but other 
         # sorts might be useful
@@ -54,13 +56,12 @@ class Dummy(Peer):
         # request all available pieces from all peers!
         # (up to self.max_requests from each)
         for peer in peers:
-            av_set = set(peer.available_pieces)
-            isect = av_set.intersection(np_set)
+            isect = peer.available_pieces & np_set
             n = min(self.max_requests, len(isect))
             # More symmetry breaking -- ask for random pieces.
             # This would be the place to try fancier piece-requesting strategies
             # to avoid getting the same thing from multiple peers at a time.
-            for piece_id in random.sample(sorted(isect), n):
+            for piece_id in self.rng.sample(sorted(isect), n):
                 # aha! The peer has this piece! Request it.
                 # which part of the piece do we need next?
                 # (must get the next-needed blocks in order)
@@ -82,8 +83,8 @@ class Dummy(Peer):
         """
 
         round = history.current_round()
-        logging.debug("%s again.  It's round %d." % (
-            self.id, round))
+        logging.debug("%s again.  It's round %d.",
+            self.id, round)
         # One could look at other stuff in the history too here.
         # For example, history.downloads[round-1] (if round != 0, of course)
         # has a list of Download objects for each Download to this peer in
@@ -98,7 +99,7 @@ class Dummy(Peer):
             # change my internal state for no reason
             self.dummy_state["cake"] = "pie"
 
-            request = random.choice(requests)
+            request = self.rng.choice(requests)
             chosen = [request.requester_id]
             # Evenly "split" my upload bandwidth among the one chosen requester
             bws = even_split(self.up_bw, len(chosen))
@@ -1,7 +1,252 @@
 #!/usr/bin/python
 
-import copy
+import json
+import mmap
+import os
 import pprint
+from array import array
+from collections.abc import Sequence
+
+from messages import Upload, Download
+
+
+class PeerIndex:
+    """Peer id <-> small int, for storing ids in typed arrays"""
+    def __init__(self, peer_ids):
+        self.names = []
+        self.index = dict()
+        for pid in peer_ids:
+            self.id(pid)
+
+    def id(self, peer_id):
+        """The int for peer_id, allocating one if it is new"""
+        i = self.index.get(peer_id)
+        if i is None:
+            i = len(self.names)
+            self.names.append(peer_id)
+            self.index[peer_id] = i
+        return i
+
+
+class ColumnFile:
+    """
+    An append-only typed column in a file, read back through mmap.  Looks
+    enough like an array for MessageTable: append, len, indexing, iteration.
+    Appends are buffered in memory until flush(), which History calls once
+    a round, so only the current round is ever held in RAM.
+    """
+    def __init__(self, path, typecode):
+        self.typecode = typecode
+        self.file = open(path, "ab+")
+        self.flushed = os.path.getsize(path) // array(typecode).itemsize
+        self.buffer = array(typecode)
+        self.view = None  # memoryview over the mmapped file, if mapped
+
+    def append(self, v):
+        self.buffer.append(v)
+
+    def flush(self):
+        if self.buffer:
+            self.buffer.tofile(self.file)
+            self.file.flush()
+            self.flushed += len(self.buffer)
+            self.buffer = array(self.typecode)
+            # The file grew: remap on the next read
+            self.view = None
+
+    def mapped(self):
+        if self.view is None:
+            if self.flushed == 0:
+                self.view = array(self.typecode)
+            else:
+                m = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+                self.view = memoryview(m).cast(self.typecode)
+        return self.view
+
+    def __len__(self):
+        return self.flushed + len(self.buffer)
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if i < self.flushed:
+            return self.mapped()[i]
+        return self.buffer[i - self.flushed]
+
+    def __iter__(self):
+        for v in self.mapped():
+            yield v
+        for v in self.buffer:
+            yield v
+
+    def __getstate__(self):
+        raise TypeError("History logs live on disk; reopen with History.open()")
+
+
+class MessageTable:
+    """
+    Messages of one kind, stored column-wise: one typed array per field, one
+    row per message.  Every table has round, from and to columns; subclasses
+    add the rest.  With a log_dir the columns are ColumnFiles named
+    <kind>.<column> in that directory instead of in-memory arrays.
+
+    Rows are appended a round at a time, grouped by owner (a peer, in
+    peer_ids order), so
+        offsets[r*n + k] .. offsets[r*n + k + 1]  are the rows of owner k in round r
+        offsets[r*n] .. offsets[(r+1)*n]          are all the rows of round r
+    where n is the number of peers.
+    """
+    kind = None
+
+    def __init__(self, peers, n, log_dir=None):
+        self.peers = peers  # PeerIndex
+        self.n = n
+        self.log_dir = log_dir
+        self.columns = []
+        self.round = self.column("round", "i")
+        self.from_id = self.column("from_id", "i")
+        self.to_id = self.column("to_id", "i")
+        self.offsets = self.column("offsets", "q")
+        if len(self.offsets) == 0:
+            self.offsets.append(0)
+
+    def column(self, name, typecode):
+        if self.log_dir is None:
+            c = array(typecode)
+        else:
+            path = os.path.join(self.log_dir, "%s.%s" % (self.kind, name))
+            c = ColumnFile(path, typecode)
+        self.columns.append(c)
+        return c
+
+    def flush(self):
+        if self.log_dir is not None:
+            for c in self.columns:
+                c.flush()
+
+    def __len__(self):
+        return len(self.round)
+
+    def rounds(self):
+        return (len(self.offsets) - 1) // self.n
+
+    def append_round(self, by_owner):
+        """by_owner: one list of messages per owner, in peer_ids order"""
+        r = self.rounds()
+        for msgs in by_owner:
+            for m in msgs:
+                self.round.append(r)
+                self.from_id.append(self.peers.id(m.from_id))
+                self.to_id.append(self.peers.id(m.to_id))
+                self.append_fields(m)
+            self.offsets.append(len(self.round))
+
+    def span(self, r, k=None):
+        """(start, end) rows of round r, for owner k only if given"""
+        if k is None:
+            return (self.offsets[r * self.n], self.offsets[(r + 1) * self.n])
+        i = r * self.n + k
+        return (self.offsets[i], self.offsets[i + 1])
+
+    def messages(self, r, k):
+        """The list of messages of owner k in round r"""
+        (start, end) = self.span(r, k)
+        return [self.message(i) for i in range(start, end)]
+
+
+class DownloadTable(MessageTable):
+    """Downloads, owned by the peer that downloaded (to_id)"""
+    kind = "downloads"
+
+    def __init__(self, peers, n, log_dir=None):
+        MessageTable.__init__(self, peers, n, log_dir)
+        self.piece = self.column("piece", "i")
+        self.blocks = self.column("blocks", "q")
+
+    def append_fields(self, d):
+        self.piece.append(d.piece)
+        self.blocks.append(d.blocks)
+
+    def message(self, i):
+        names = self.peers.names
+        return Download(names[self.from_id[i]], names[self.to_id[i]],
+                        self.piece[i], self.blocks[i])
+
+
+class UploadTable(MessageTable):
+    """Uploads, owned by the uploader (from_id)"""
+    kind = "uploads"
+
+    def __init__(self, peers, n, log_dir=None):
+        MessageTable.__init__(self, peers, n, log_dir)
+        self.bw = self.column("bw", "q")
+
+    def append_fields(self, u):
+        self.bw.append(u.bw)
+
+    def message(self, i):
+        names = self.peers.names
+        return Upload(names[self.from_id[i]], names[self.to_id[i]], self.bw[i])
+
+
+class RoundsView(Sequence):
+    """
+    Looks like a list with one list of messages per round, for one owner.
+    The message lists are built from the table on access.
+    """
+    def __init__(self, table, k):
+        self.table = table
+        self.k = k
+
+    def __len__(self):
+        return self.table.rounds()
+
+    def __getitem__(self, r):
+        if isinstance(r, slice):
+            return [self[i] for i in range(*r.indices(len(self)))]
+        n = len(self)
+        if r < 0:
+            r += n
+        if r < 0 or r >= n:
+            raise IndexError("round out of range")
+        return self.table.messages(r, self.k)
+
+    def __repr__(self):
+        return repr(list(self))
+
+
+class PeerAggregates:
+    """
+    Running summaries of one peer's history, kept up to date by History.update
+    so that agents don't have to rescan it every round.
+
+    received: [{from_id: blocks}]  one dict per round: blocks this peer got
+              from each uploader, in order of first download.  Only the
+              last `window` rounds if window is set.
+    gave:     {to_id: bw}  what this peer uploaded to each peer last round
+    streaks:  {from_id: n}  number of consecutive rounds, up to and including
+              the last one, in which from_id uploaded to this peer
+    """
+    def __init__(self, window=None):
+        self.window = window
+        self.received = []
+        self.gave = dict()
+        self.streaks = dict()
+
+    def update(self, downloads, uploads):
+        got = dict()
+        for d in downloads:
+            got[d.from_id] = got.get(d.from_id, 0) + d.blocks
+        self.received.append(got)
+        if self.window is not None and len(self.received) > self.window:
+            del self.received[:-self.window]
+
+        gave = dict()
+        for u in uploads:
+            gave[u.to_id] = gave.get(u.to_id, 0) + u.bw
+        self.gave = gave
+
+        self.streaks = dict((pid, self.streaks.get(pid, 0) + 1) for pid in got)
 
 
 class AgentHistory:
@@ -10,18 +255,64 @@ class AgentHistory:
 
     history.downloads: [[Download objects for round]]  (one sublist for each round)
          All the downloads _to_ this agent.
-        
+
     history.uploads: [[Upload objects for round]]  (one sublist for each round)
          All the downloads _from_ this agent.
 
+    Common questions are answered from running summaries, without a scan:
+    received_from(), uploaded_to() and reciprocation_streaks().
+    Each returns a fresh dict that the agent is free to change.
     """
-    def __init__(self, peer_id, downloads, uploads):
+    def __init__(self, peer_id, downloads, uploads, aggregates=None):
         """
         Pull out just the info for peer_id.
         """
         self.uploads = uploads
         self.downloads = downloads
         self.peer_id = peer_id
+        if aggregates is None:
+            aggregates = PeerAggregates()
+        self.aggregates = aggregates
+        self._received = dict()  # rounds -> received_from(rounds), this round
+        self._received_round = None
+
+    def received_from(self, rounds=1):
+        """
+        dict : from_id -> blocks downloaded from that peer over the last
+        `rounds` rounds (fewer if the sim hasn't run that long).  Only peers
+        that uploaded something are in it, oldest uploader first.
+        """
+        if rounds <= 0:
+            return dict()
+        received = self.aggregates.received
+        if self._received_round != len(self.downloads):
+            self._received = dict()
+            self._received_round = len(self.downloads)
+        totals = self._received.get(rounds)
+        if totals is None:
+            totals = dict()
+            # Rounds older than the summaries keep come from the downloads
+            n = len(self.downloads)
+            for r in range(max(0, n - rounds), n - len(received)):
+                for d in self.downloads[r]:
+                    totals[d.from_id] = totals.get(d.from_id, 0) + d.blocks
+            for got in received[-rounds:]:
+                for (pid, blocks) in got.items():
+                    totals[pid] = totals.get(pid, 0) + blocks
+            self._received[rounds] = totals
+        return dict(totals)
+
+    def uploaded_to(self):
+        """dict : to_id -> bandwidth this peer gave to_id last round"""
+        return dict(self.aggregates.gave)
+
+    def reciprocation_streaks(self):
+        """
+        dict : from_id -> number of consecutive rounds, up to and including
+        the last one, in which from_id uploaded to this peer.  Peers that
+        didn't upload last round aren't in it.
+        """
+        return dict(self.aggregates.streaks)
 
     def last_round(self):
         return len(self.downloads)-1
@@ -32,39 +323,84 @@ class AgentHistory:
 
     def __repr__(self):
         return "AgentHistory(downloads=%s, uploads=%s)" % (
-            pprint.pformat(self.downloads),
-            pprint.pformat(self.uploads))
+            pprint.pformat(list(self.downloads)),
+            pprint.pformat(list(self.uploads)))
 
 
 class History:
     """History of the whole sim"""
-    def __init__(self, peer_ids, upload_rates):
+
+    # Rounds of per-peer summaries kept in memory, whether or not the
+    # history is logged.  AgentHistory.received_from reads older rounds back
+    # from the tables (or the log).
+    AGGREGATE_ROUNDS = 16
+
+    def __init__(self, peer_ids, upload_rates, log_dir=None):
         """
         uploads:
                    dict : peer_id -> [[uploads] -- one list per round]
         downloads:
                    dict : peer_id -> [[downloads] -- one list per round]
-                   
+
         Keep track of the uploads _from_ and downloads _to_ the
         specified peer id.
+
+        Both are views on column tables (download_table, upload_table), which
+        is where the data actually lives.
+
+        log_dir: if given, the tables are append-only files in that
+        directory, written every round and read back through mmap, so
+        memory doesn't grow with the number of rounds.  write_meta() saves
+        what History.open() needs to read the log back later.
         """
         self.upload_rates = upload_rates  # peer_id -> up_bw
         self.peer_ids = peer_ids[:]
+        self.log_dir = log_dir
 
         self.round_done = dict()   # peer_id -> round finished
-        self.downloads = dict((pid, []) for pid in peer_ids)
-        self.uploads = dict((pid, []) for pid in peer_ids)
+        self.peers = PeerIndex(self.peer_ids)
+        n = len(self.peer_ids)
+        self.download_table = DownloadTable(self.peers, n, log_dir)
+        self.upload_table = UploadTable(self.peers, n, log_dir)
+        self.downloads = dict((pid, RoundsView(self.download_table, k))
+                              for (k, pid) in enumerate(self.peer_ids))
+        self.uploads = dict((pid, RoundsView(self.upload_table, k))
+                            for (k, pid) in enumerate(self.peer_ids))
+        self.aggregates = dict((pid, PeerAggregates(self.AGGREGATE_ROUNDS))
+                               for pid in self.peer_ids)
+
+    @staticmethod
+    def open(log_dir):
+        """Reopen a History that was logged to log_dir, for reading"""
+        with open(os.path.join(log_dir, "meta.json")) as f:
+            meta = json.load(f)
+        h = History(meta["peer_ids"], meta["upload_rates"], log_dir)
+        for pid in meta["ids"]:
+            h.peers.id(pid)
+        h.round_done = meta["round_done"]
+        return h
+
+    def write_meta(self):
+        """Save everything but the tables into the log directory"""
+        meta = dict(peer_ids=self.peer_ids, ids=self.peers.names,
+                    upload_rates=self.upload_rates, round_done=self.round_done)
+        with open(os.path.join(self.log_dir, "meta.json"), "w") as f:
+            json.dump(meta, f)
 
     def update(self, dls, ups):
         """
         dls: dict : peer_id -> [downloads] -- downloads for this round
         ups: dict : peer_id -> [uploads] -- uploads for this round
 
-        append these downloads to to the history
+        append these downloads to to the history, and bring the per-peer
+        aggregates up to date
         """
+        self.download_table.append_round([dls[pid] for pid in self.peer_ids])
+        self.upload_table.append_round([ups[pid] for pid in self.peer_ids])
+        self.download_table.flush()
+        self.upload_table.flush()
         for pid in self.peer_ids:
-            self.downloads[pid].append(dls[pid])
-            self.uploads[pid].append(ups[pid])
+            self.aggregates[pid].update(dls[pid], ups[pid])
 
     def peer_is_done(self, round, peer_id):
         # Only save the _first_ round where we hear this
@@ -72,33 +408,42 @@ class History:
             self.round_done[peer_id] = round
 
     def peer_history(self, peer_id):
-        return AgentHistory(peer_id, self.downloads[peer_id], self.uploads[peer_id])
+        return AgentHistory(peer_id, self.downloads[peer_id], self.uploads[peer_id],
+                            self.aggregates[peer_id])
 
     def last_round(self):
         """index of the last completed round"""
-        p = self.peer_ids[0]
-        return len(self.downloads[p])-1
+        return self.download_table.rounds()-1
+
+    def uploaded_blocks(self):
+        """dict : peer_id -> total blocks others downloaded from peer_id"""
+        t = self.download_table
+        totals = [0] * len(self.peers.names)
+        for (f, b) in zip(t.from_id, t.blocks):
+            totals[f] += b
+        return dict(zip(self.peers.names, totals))
 
     def pretty_for_round(self, r):
-        s = "\nRound %s:\n" % r
-        for peer_id in self.peer_ids:
-            ds = self.downloads[peer_id][r]
-            stringify = lambda d: "%s downloaded %d blocks of piece %d from %s\n" % (
-                peer_id, d.blocks, d.piece, d.from_id)
-            s += "".join(map(stringify, ds))
-        return s
+        t = self.download_table
+        names = self.peers.names
+        lines = ["\nRound %s:\n" % r]
+        for (k, peer_id) in enumerate(self.peer_ids):
+            (start, end) = t.span(r, k)
+            lines.extend("%s downloaded %d blocks of piece %d from %s\n" % (
+                peer_id, t.blocks[i], t.piece[i], names[t.from_id[i]])
+                for i in range(start, end))
+        return "".join(lines)
 
     def pretty(self):
-        s = "History\n"
-        for r in range(self.last_round()+1):
-            s += self.pretty_for_round(r)
-        return s
+        # One join at the end: adding up the rounds one by one is quadratic
+        return "".join(["History\n"] +
+                       [self.pretty_for_round(r) for r in range(self.last_round()+1)])
 
     def __repr__(self):
         return """History(
 uploads=%s
 downloads=%s
 )""" % (
-    pprint.pformat(self.uploads),
-    pprint.pformat(self.downloads))
+    pprint.pformat(dict((pid, list(v)) for (pid, v) in self.uploads.items())),
+    pprint.pformat(dict((pid, list(v)) for (pid, v) in self.downloads.items())))
 
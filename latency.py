@@ -0,0 +1,110 @@
+#!/usr/bin/python
+
+"""
+How long agents take to decide.  Sim.run_sim_once takes an optional
+CallLatencies and records the wall time of every requests() and uploads()
+call in it, per agent class and peer id.
+
+A CallLatencies can also hold a per-call budget.  A call that goes over it
+is counted, and with penalize its output is thrown away: the peer makes
+no requests (or uploads) that round.  Wall time depends on the machine,
+so penalized runs aren't reproducible from the seed alone.
+
+A CallLatencies holds one run's calls.  LatencyStats sums up any number
+of runs in memory that doesn't grow with the number of runs: a
+util.LogHistogram per peer and per agent class, whose percentiles are
+within about 4% of the exact ones, and never below them.
+"""
+
+import logging
+from array import array
+
+from util import LogHistogram
+
+METHODS = ["requests", "uploads"]
+
+
+class CallLatencies:
+    def __init__(self, budget=None, penalize=False):
+        """budget: seconds per call, or None for no limit"""
+        self.budget = budget
+        self.penalize = penalize
+        self.times = dict()  # (method, class name, peer id) -> array of seconds
+        self.over = dict()   # (method, class name, peer id) -> calls over budget
+
+    def record(self, method, agent_class, peer_id, seconds):
+        """Record one call.  Returns True if its output should be dropped."""
+        key = (method, agent_class, peer_id)
+        times = self.times.get(key)
+        if times is None:
+            times = self.times[key] = array("d")
+        times.append(seconds)
+
+        if self.budget is None or seconds <= self.budget:
+            return False
+        logging.info("%s.%s took %.1f ms, over the %.1f ms budget%s",
+                     peer_id, method, 1000 * seconds, 1000 * self.budget,
+                     ": output dropped" if self.penalize else "")
+        self.over[key] = self.over.get(key, 0) + 1
+        return self.penalize
+
+
+class LatencyStats:
+    def __init__(self):
+        self.peers = dict()    # (method, class name, peer id) -> LogHistogram
+        self.classes = dict()  # (method, class name) -> LogHistogram
+        self.over = dict()     # (method, class name, peer id) -> calls over budget
+
+    def add(self, latencies):
+        """Add one run's CallLatencies"""
+        for ((method, cls, peer_id), times) in latencies.times.items():
+            for (stats, key) in ((self.peers, (method, cls, peer_id)),
+                                 (self.classes, (method, cls))):
+                hist = stats.get(key)
+                if hist is None:
+                    hist = stats[key] = LogHistogram()
+                for t in times:
+                    hist.add(t)
+        for (key, n) in latencies.over.items():
+            self.over[key] = self.over.get(key, 0) + n
+
+    def over_budget(self):
+        """Lines naming each peer with calls over the budget"""
+        lines = []
+        for key in sorted(self.over, key=lambda k: (k[2], k[0])):
+            (method, cls, peer_id) = key
+            lines.append("%s.%s (%s): %d of %d calls" % (
+                peer_id, method, cls, self.over[key], self.peers[key].n))
+        return lines
+
+    def grouped(self, by_peer):
+        """(method, name) -> (stats, calls over budget), where name is the
+        peer id if by_peer, else the agent class name"""
+        groups = dict()
+        if by_peer:
+            for ((method, cls, peer_id), stats) in self.peers.items():
+                groups[(method, peer_id)] = (
+                    stats, self.over.get((method, cls, peer_id), 0))
+        else:
+            for ((method, cls), stats) in self.classes.items():
+                over = sum(n for (k, n) in self.over.items()
+                           if k[:2] == (method, cls))
+                groups[(method, cls)] = (stats, over)
+        return groups
+
+    def table(self, by_peer=False):
+        """Percentiles in ms as a table of lines, slowest p99 first.  The
+        percentiles are rounded up to a histogram bucket; max is exact."""
+        lines = ["%-10s %-20s %8s %9s %9s %9s %9s %6s" % (
+            "call", "peer" if by_peer else "agent", "calls",
+            "p50 ms", "p95 ms", "p99 ms", "max ms", "over")]
+        rows = []
+        for ((method, name), (stats, over)) in self.grouped(by_peer).items():
+            rows.append((stats.quantile(0.99), method, name, stats, over))
+        rows.sort(key=lambda row: (METHODS.index(row[1]), -row[0], row[2]))
+        for (p99, method, name, stats, over) in rows:
+            lines.append("%-10s %-20s %8d %9.3f %9.3f %9.3f %9.3f %6d" % (
+                method, name, stats.n,
+                1000 * stats.quantile(0.5), 1000 * stats.quantile(0.95),
+                1000 * p99, 1000 * stats.max, over))
+        return lines
@@ -6,10 +6,10 @@
 # You'll want to copy this file to AgentNameXXX.py for various versions of XXX,
 # probably get rid of the silly logging messages, and then add more logic.
 
-import random
 import logging
 
 from messages import Upload, Request
+from pieceset import PieceSet
 from util import even_split
 from peer import Peer
 
@@ -30,14 +30,14 @@ class MaxncodyPropShare(Peer):
         """
         needed = lambda i: self.pieces[i] < self.conf.blocks_per_piece
         needed_pieces = list(filter(needed, list(range(len(self.pieces)))))
-        np_set = set(needed_pieces)  # sets support fast intersection ops.
+        np_set = PieceSet(needed_pieces)  # bitsets make intersections cheap.
 
 
         # logging.debug("%s here: still need pieces %s" % (self.id, needed_pieces))
 
         # logging.debug("%s still here. Here are some peers:" % self.id)
         for p in peers:
-            logging.debug("id: %s, available pieces: %s" % (p.id, p.available_pieces))
+            logging.debug("id: %s, available pieces: %s", p.id, p.available_pieces)
 
         # logging.debug("And look, I have my entire history available too:")
         # logging.debug("look at the AgentHistory class in history.py for details")
@@ -45,7 +45,7 @@ class MaxncodyPropShare(Peer):
 
         requests = []   # We'll put all the things we want here
         # Symmetry breaking is good...
-        random.shuffle(needed_pieces)
+        self.rng.shuffle(needed_pieces)
         
         # Sort peers by id.  This is probably not a useful sort, but other 
         # sorts might be useful
@@ -53,13 +53,12 @@ class MaxncodyPropShare(Peer):
         # request all available pieces from all peers!
         # (up to self.max_requests from each)
         for peer in peers:
-            av_set = set(peer.available_pieces)
-            isect = av_set.intersection(np_set)
+            isect = peer.available_pieces & np_set
             n = min(self.max_requests, len(isect))
             # More symmetry breaking -- ask for random pieces.
             # This would be the place to try fancier piece-requesting strategies
             # to avoid getting the same thing from multiple peers at a time.
-            for piece_id in random.sample(sorted(isect), n):
+            for piece_id in self.rng.sample(sorted(isect), n):
                 # aha! The peer has this piece! Request it.
                 # which part of the piece do we need next?
                 # (must get the next-needed blocks in order)
@@ -85,18 +84,19 @@ class MaxncodyPropShare(Peer):
             return []
 
         # Identify all unique peers currently requesting data
-        requester_ids = list(set(r.requester_id for r in requests))
+        # In request order (a set's order would depend on string hashing)
+        requester_ids = list(dict.fromkeys(r.requester_id for r in requests))
         
         contributions = {p_id: 0 for p_id in requester_ids}
         total_contributed = 0
 
         if round > 0:
-            # Check all downloads I received in the previous round
-            for download in history.downloads[round-1]:
-                # If the download was to me, AND came from someone currently requesting
-                if download.to_id == self.id and download.from_id in contributions:
-                    contributions[download.from_id] += download.blocks
-                    total_contributed += download.blocks
+            # Check what I received from each peer in the previous round
+            for from_id, blocks in history.received_from(1).items():
+                # If it came from someone currently requesting
+                if from_id in contributions:
+                    contributions[from_id] += blocks
+                    total_contributed += blocks
 
         # 90% for contributors, 10% for optimistic
         # Use self.up_bw to get actual block count
@@ -114,7 +114,7 @@ class MaxncodyPropShare(Peer):
                     bws[p_id] = int(share)
         
         # The 10%
-        choice = random.choice(requester_ids)
+        choice = self.rng.choice(requester_ids)
         
         if choice in bws:
             bws[choice] += optimistic_bw
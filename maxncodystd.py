@@ -1,8 +1,8 @@
 #!/usr/bin/python
-import random
 import logging
 
 from messages import Upload, Request
+from pieceset import PieceSet
 from util import even_split
 from peer import Peer
 
@@ -28,22 +28,13 @@ class MaxncodyStd(Peer):
         """
         needed = lambda i: self.pieces[i] < self.conf.blocks_per_piece
         needed_pieces = list(filter(needed, list(range(len(self.pieces)))))
-        np_set = set(needed_pieces)  # sets support fast intersection ops.
+        np_set = PieceSet(needed_pieces)  # bitsets make intersections cheap.
 
 
-        #avaliability for rarity sorting
-        availability = {}
-
-        for piece_id in needed_pieces:
-            availability[piece_id] = 0
-        for peer in peers:
-            for piece_id in peer.available_pieces:
-                if piece_id in availability:
-                    availability[piece_id] += 1
-
-        #sort by rarity, use random to tiebreak
-        random.shuffle(needed_pieces)
-        needed_pieces.sort(key=lambda p: availability[p])
+        #sort by rarity (availability is kept by the sim), use random to tiebreak
+        self.rng.shuffle(needed_pieces)
+        needed_pieces.sort(key=lambda p: self.availability[p])
+        rarest = self.first_wanted(needed_pieces)
 
         requests = []   # We'll put all the things we want here
         # Symmetry breaking is good...
@@ -51,10 +42,9 @@ class MaxncodyStd(Peer):
         # request all available pieces from all peers!
         # (up to self.max_requests from each)
         for peer in peers:
-            av_set = set(peer.available_pieces)
-            isect = av_set.intersection(np_set)
+            isect = peer.available_pieces & np_set
             #filter on rarest first
-            peer_pieces = [p for p in needed_pieces if p in isect]
+            peer_pieces = rarest(isect)
 
             n = min(self.max_requests, len(peer_pieces))
             for piece_id in peer_pieces[:n]:
@@ -83,16 +73,11 @@ class MaxncodyStd(Peer):
         if len(requests) == 0:
             return []
         else:
-            requesting_peers = set(r.requester_id for r in requests)
-            #rank peers by download rate for reciprocation 
-            download_totals = {}
-            lookback = min(round, 2)  #up to 2 rounds
-            for r in range(max(0, round - lookback), round):
-                for download in history.downloads[r]:
-                    if download.from_id in requesting_peers:
-                        download_totals[download.from_id] = (
-                            download_totals.get(download.from_id, 0) + download.blocks
-                        )
+            #a dict rather than a set: iterates in request order, not hash order
+            requesting_peers = dict.fromkeys(r.requester_id for r in requests)
+            #rank peers by download rate for reciprocation, up to 2 rounds back
+            download_totals = {pid: blocks for pid, blocks in history.received_from(2).items()
+                               if pid in requesting_peers}
             
             #sort peers by how much they gave us 
             givers = [(pid, blocks) for pid, blocks in download_totals.items() if blocks > 0]
@@ -106,7 +91,7 @@ class MaxncodyStd(Peer):
     
             if (round % 3 == 0) or (self.optimistic_unblock not in remaining):
                 if remaining:
-                    self.optimistic_unblock = random.choice(list(remaining))
+                    self.optimistic_unblock = self.rng.choice(list(remaining))
                 else:
                     self.optimistic_unblock = None
 
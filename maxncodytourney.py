@@ -6,10 +6,10 @@
 # You'll want to copy this file to AgentNameXXX.py for various versions of XXX,
 # probably get rid of the silly logging messages, and then add more logic.
 
-import random
 import logging
 
 from messages import Upload, Request
+from pieceset import PieceSet
 from util import even_split
 from peer import Peer
 
@@ -43,29 +43,21 @@ class MaxncodyTourney(Peer):
         """
         needed = lambda i: self.pieces[i] < self.conf.blocks_per_piece
         needed_pieces = list(filter(needed, list(range(len(self.pieces)))))
-        np_set = set(needed_pieces)  # sets support fast intersection ops.
+        np_set = PieceSet(needed_pieces)  # bitsets make intersections cheap.
 
         if not needed_pieces:
             return []
         
-        #same rarity first logic
-        availability = {}
-        for piece_id in needed_pieces:
-            availability[piece_id] = 0
-        for peer in peers:
-            for piece_id in peer.available_pieces:
-                if piece_id in availability:
-                    availability[piece_id] += 1
-
-        random.shuffle(needed_pieces)
-        needed_pieces.sort(key=lambda p: availability[p])
+        #same rarity first logic, counts come from the sim
+        self.rng.shuffle(needed_pieces)
+        needed_pieces.sort(key=lambda p: self.availability[p])
+        rarest = self.first_wanted(needed_pieces)
 
         requests = []   # We'll put all the things we want here
 
         for peer in peers:
-            av_set = set(peer.available_pieces)
-            isect = av_set.intersection(np_set)
-            peer_pieces = [p for p in needed_pieces if p in isect]
+            isect = peer.available_pieces & np_set
+            peer_pieces = rarest(isect)
             n = min(self.max_requests, len(peer_pieces))
             for piece_id in peer_pieces[:n]:
                 start_block = self.pieces[piece_id]
@@ -89,16 +81,11 @@ class MaxncodyTourney(Peer):
         if len(requests) == 0:
             return []
         #bootstrap
-        requesting_peers = set(r.requester_id for r in requests)
+        #a dict rather than a set: iterates in request order, not hash order
+        requesting_peers = dict.fromkeys(r.requester_id for r in requests)
         if round < self.bootstrap_rounds:
-            download_totals = {}
-            lookback = min(round, 2)
-            for r_idx in range(max(0, round - lookback), round):
-                for download in history.downloads[r_idx]:
-                    if download.from_id in requesting_peers:
-                        download_totals[download.from_id] = (
-                            download_totals.get(download.from_id, 0) + download.blocks
-                        )
+            download_totals = {pid: blocks for pid, blocks in history.received_from(2).items()
+                               if pid in requesting_peers}
 
             givers = [(pid, blocks) for pid, blocks in download_totals.items() if blocks > 0]
             givers.sort(key=lambda x: x[1], reverse=True)
@@ -107,7 +94,7 @@ class MaxncodyTourney(Peer):
             remaining = [pid for pid in requesting_peers if pid not in regular]
             if (round % 3 == 0) or (self.optimistic_unblock not in remaining):
                 if remaining:
-                    self.optimistic_unblock = random.choice(remaining)
+                    self.optimistic_unblock = self.rng.choice(remaining)
                 else:
                     self.optimistic_unblock = None
 
@@ -117,7 +104,7 @@ class MaxncodyTourney(Peer):
                     chosen.append(self.optimistic_unblock)
 
             if not chosen:
-                chosen = list(random.sample(list(requesting_peers), min(4, len(requesting_peers))))
+                chosen = list(self.rng.sample(list(requesting_peers), min(4, len(requesting_peers))))
 
             bws = even_split(self.up_bw, len(chosen))
             self.my_unblocks = set(chosen)
@@ -134,11 +121,7 @@ class MaxncodyTourney(Peer):
 
         #update estimates from last round
         if round > 0:
-            last_round_uploaders = {}
-            for download in history.downloads[round - 1]:
-                last_round_uploaders[download.from_id] = (
-                    last_round_uploaders.get(download.from_id, 0) + download.blocks
-                )
+            last_round_uploaders = history.received_from(1)
 
             for peer in peers:
                 pid = peer.id
@@ -150,6 +133,9 @@ class MaxncodyTourney(Peer):
 
             #update u_j based on reciprocation
             for pid in self.my_unblocks:
+                if pid not in self.u:
+                    #unblocked while bootstrapping, no longer a neighbor
+                    continue
                 if pid in last_round_uploaders:
                     if self.unblock_history.get(pid, 0) >= self.r:
                         self.u[pid] = self.u[pid] * (1 - self.gamma)
@@ -194,7 +180,7 @@ class MaxncodyTourney(Peer):
         #pick new optimistic unblock every 3 rounds or if current one isn't requesting
         if (round % 3 == 0) or (self.optimistic_unblock not in remaining_requesters):
             if remaining_requesters:
-                self.optimistic_unblock = random.choice(remaining_requesters)
+                self.optimistic_unblock = self.rng.choice(remaining_requesters)
             else:
                 self.optimistic_unblock = None
 
@@ -6,10 +6,10 @@
 # You'll want to copy this file to AgentNameXXX.py for various versions of XXX,
 # probably get rid of the silly logging messages, and then add more logic.
 
-import random
 import logging
 
 from messages import Upload, Request
+from pieceset import PieceSet
 from util import even_split
 from peer import Peer
 
@@ -40,22 +40,13 @@ class MaxncodyTyrant(Peer):
         """
         needed = lambda i: self.pieces[i] < self.conf.blocks_per_piece
         needed_pieces = list(filter(needed, list(range(len(self.pieces)))))
-        np_set = set(needed_pieces)  # sets support fast intersection ops.
+        np_set = PieceSet(needed_pieces)  # bitsets make intersections cheap.
 
 
-        #avaliability for rarity sorting
-        availability = {}
-
-        for piece_id in needed_pieces:
-            availability[piece_id] = 0
-        for peer in peers:
-            for piece_id in peer.available_pieces:
-                if piece_id in availability:
-                    availability[piece_id] += 1
-
-        #sort by rarity, use random to tiebreak
-        random.shuffle(needed_pieces)
-        needed_pieces.sort(key=lambda p: availability[p])
+        #sort by rarity (availability is kept by the sim), use random to tiebreak
+        self.rng.shuffle(needed_pieces)
+        needed_pieces.sort(key=lambda p: self.availability[p])
+        rarest = self.first_wanted(needed_pieces)
 
         requests = []   # We'll put all the things we want here
         # Symmetry breaking is good...
@@ -63,10 +54,9 @@ class MaxncodyTyrant(Peer):
         # request all available pieces from all peers!
         # (up to self.max_requests from each)
         for peer in peers:
-            av_set = set(peer.available_pieces)
-            isect = av_set.intersection(np_set)
+            isect = peer.available_pieces & np_set
             #filter on rarest first
-            peer_pieces = [p for p in needed_pieces if p in isect]
+            peer_pieces = rarest(isect)
 
             n = min(self.max_requests, len(peer_pieces))
             for piece_id in peer_pieces[:n]:
@@ -91,7 +81,8 @@ class MaxncodyTyrant(Peer):
         if len(requests) == 0:
             return []
         
-        requesting_peers = set(r.requester_id for r in requests)
+        #a dict rather than a set: iterates in request order, not hash order
+        requesting_peers = dict.fromkeys(r.requester_id for r in requests)
 
         #init u_j and d_j for new peers
         for peer in peers:
@@ -105,11 +96,7 @@ class MaxncodyTyrant(Peer):
 
         #update d_j from download history
         if round > 0:
-            last_round_uploaders = {}
-            for download in history.downloads[round - 1]:
-                last_round_uploaders[download.from_id] = (
-                    last_round_uploaders.get(download.from_id, 0) + download.blocks
-                )
+            last_round_uploaders = history.received_from(1)
 
             #update d_j and unblock tracking
             for peer in peers:
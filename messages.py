@@ -1,35 +1,84 @@
 #!/usr/bin/python
 
-class Upload:
+import sys
+
+
+def _intern(s):
+    """Peer ids repeat in millions of messages: share one copy of each"""
+    if type(s) is str:
+        return sys.intern(s)
+    return s
+
+
+class Message:
+    """
+    Messages are immutable, slotted (no per-instance __dict__) and hashable.
+    Subclasses list their attributes in __slots__, in constructor order.
+    """
+    __slots__ = ()
+
+    def __setattr__(self, name, value):
+        raise AttributeError("%s is immutable" % self.__class__.__name__)
+
+    def __delattr__(self, name):
+        raise AttributeError("%s is immutable" % self.__class__.__name__)
+
+    def _fields(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __eq__(self, other):
+        if type(other) is not type(self):
+            return NotImplemented
+        return self._fields() == other._fields()
+
+    def __hash__(self):
+        return hash(self._fields())
+
+    def __reduce__(self):
+        # Needed for pickle / copy, which would otherwise set the slots
+        # one at a time through __setattr__
+        return (self.__class__, self._fields())
+
+
+class Upload(Message):
+    __slots__ = ("from_id", "to_id", "bw")
+
     def __init__(self, from_id, to_id, up_bw):
-        self.from_id = from_id
-        self.to_id = to_id
-        self.bw = up_bw
+        init = object.__setattr__
+        init(self, "from_id", _intern(from_id))
+        init(self, "to_id", _intern(to_id))
+        init(self, "bw", up_bw)
 
     def __repr__(self):
         return "Upload(from_id = %s, to_id=%s, bw=%d)" % (
             self.from_id, self.to_id, self.bw)
 
-class Request:
+class Request(Message):
+    __slots__ = ("requester_id", "peer_id", "piece_id", "start")
+
     def __init__(self, requester_id, peer_id, piece_id, start):
-        self.requester_id = requester_id
-        self.peer_id = peer_id   # peer data is requested from
-        self.piece_id = piece_id
-        self.start = start  # the block index
+        init = object.__setattr__
+        init(self, "requester_id", _intern(requester_id))
+        init(self, "peer_id", _intern(peer_id))   # peer data is requested from
+        init(self, "piece_id", piece_id)
+        init(self, "start", start)  # the block index
 
     def __repr__(self):
         return "Request(requester_id=%s, peer_id=%s, piece_id=%d, start=%d)" % (
             self.requester_id, self.peer_id, self.piece_id, self.start)
 
-class Download:
+class Download(Message):
     """ Not actually a message--just used for accounting and history tracking of
      what is actually downloaded.
     """
+    __slots__ = ("from_id", "to_id", "piece", "blocks")
+
     def __init__(self, from_id, to_id, piece, blocks):
-        self.from_id = from_id  # who did the agent download from?
-        self.to_id = to_id      # Who downloaded?
-        self.piece = piece      # Which piece?
-        self.blocks = blocks    # How much did the agent download?
+        init = object.__setattr__
+        init(self, "from_id", _intern(from_id))  # who did the agent download from?
+        init(self, "to_id", _intern(to_id))      # Who downloaded?
+        init(self, "piece", piece)      # Which piece?
+        init(self, "blocks", blocks)    # How much did the agent download?
 
     def __repr__(self):
         return "Download(from_id=%s, to_id=%s, piece=%d, blocks=%d)" % (
@@ -37,16 +86,22 @@ class Download:
 
 
 
-            
-class PeerInfo:
+
+class PeerInfo(Message):
     """
     Only passing peer ids and the pieces they have available to each agent.
     This prevents them from accidentally messing up the state of other agents.
     """
+    __slots__ = ("id", "available_pieces")
+
     def __init__(self, id, available):
-        self.id = id
-        self.available_pieces = available
+        init = object.__setattr__
+        init(self, "id", _intern(id))
+        init(self, "available_pieces", available)
+
+    def __hash__(self):
+        # available_pieces needn't be hashable
+        return hash(self.id)
 
     def __repr__(self):
         return "PeerInfo(id=%s)" % self.id
-
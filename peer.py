@@ -1,14 +1,25 @@
 #!/usr/bin/python
 
+import heapq
 import random
 from messages import Upload, Request
 from util import even_split
 
 class Peer:
-    def __init__(self, config, id, init_pieces, up_bandwidth):
+    # The sim doesn't call requests() once a peer has every piece, or
+    # uploads() in a round nobody asked it for anything.  Agents that want
+    # both calls every round regardless set this to True.
+    every_round = False
+
+    def __init__(self, config, id, init_pieces, up_bandwidth, rng=None):
         self.conf = config
         self.id = id
+        # This peer's own random stream.  Use it instead of the random
+        # module, so runs are reproducible however the peers are scheduled.
+        self.rng = rng if rng is not None else random.Random()
         self.pieces = init_pieces[:]
+        # piece_id -> number of peers holding it; kept up to date by the sim
+        self.availability = {}
         # bandwidth measured in blocks-per-time-period
         self.up_bw = round(up_bandwidth)
 
@@ -31,6 +42,29 @@ class Peer:
         """
         self.pieces = new_pieces
 
+    def update_availability(self, availability):
+        """
+        Called by the sim before requests() with a read-only view of the
+        swarm-wide piece_id -> number of peers that have the piece.
+        """
+        self.availability = availability
+
+    def first_wanted(self, wanted):
+        """
+        wanted: piece ids, most wanted first.
+
+        Returns a function that takes some of those pieces (say, the ones a
+        peer has: its available_pieces & a PieceSet of wanted) and returns
+        the first max_requests of them in wanted's order.  It makes one pass
+        over the pieces it's given rather than testing each wanted piece
+        for membership.
+        """
+        rank = [0] * len(self.pieces)
+        for (k, p) in enumerate(wanted):
+            rank[p] = k
+        return lambda pieces: heapq.nsmallest(self.max_requests, pieces,
+                                              key=rank.__getitem__)
+
     def requests(self, peers, history):
         return []
 
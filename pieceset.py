@@ -0,0 +1,188 @@
+#!/usr/bin/python
+
+"""
+A set of piece ids stored as the bits of one Python int.  Intersections,
+differences and unions are single big-int operations, one machine word per
+64 pieces, instead of hashing every piece id into a new set.
+
+Works as a drop-in for the parts of the set API agents use: &, |, -, ^,
+in, len, iteration (in increasing order), intersection(), difference(),
+union(), issubset(), ...  Mixing with ordinary sets works too:
+`piece_set & {1, 2}` gives a PieceSet.
+
+`in` shifts the whole int, so it costs one machine word per 64 pieces.
+That's fine for a few tests, but to go through many pieces, iterate the
+set (or an intersection with it) instead of testing them one by one.
+"""
+
+import itertools
+import operator
+
+
+try:
+    _popcount = int.bit_count
+except AttributeError:  # Python < 3.10
+    def _popcount(bits):
+        return bin(bits).count("1")
+
+
+# Between binary digits and bytes 0 and 1
+_BIT_VALUES = bytes.maketrans(b"01", b"\x00\x01")
+_BIT_DIGITS = bytes.maketrans(b"\x00\x01", b"01")
+
+
+def _bits_of(pieces):
+    """The bits for any iterable of non-negative piece ids.  Linear: marks
+    one byte per piece and converts them once, instead of building a new
+    big int per piece."""
+    if isinstance(pieces, PieceSet):
+        return pieces._bits
+    ids = list(map(operator.index, pieces))
+    if not ids:
+        return 0
+    if min(ids) < 0:
+        raise ValueError("negative piece id")
+    flags = bytearray(max(ids) + 1)
+    for i in ids:
+        flags[i] = 1
+    return int(flags[::-1].translate(_BIT_DIGITS), 2)
+
+
+class PieceSet:
+    __slots__ = ("_bits",)
+
+    def __init__(self, pieces=()):
+        self._bits = _bits_of(pieces)
+
+    @staticmethod
+    def from_bits(bits):
+        s = PieceSet()
+        s._bits = bits
+        return s
+
+    @staticmethod
+    def all(num_pieces):
+        """Every piece id in range(num_pieces)"""
+        return PieceSet.from_bits((1 << num_pieces) - 1)
+
+    def bits(self):
+        return self._bits
+
+    # Queries
+
+    def __contains__(self, i):
+        try:
+            i = operator.index(i)
+        except TypeError:
+            return False
+        return i >= 0 and (self._bits >> i) & 1 == 1
+
+    def __len__(self):
+        return _popcount(self._bits)
+
+    def __bool__(self):
+        return self._bits != 0
+
+    def __iter__(self):
+        # One byte per bit, lowest first, and pick out the positions of the
+        # 1s: linear, and all done in C
+        flags = format(self._bits, "b")[::-1].encode("ascii")
+        return itertools.compress(itertools.count(),
+                                  flags.translate(_BIT_VALUES))
+
+    def __eq__(self, other):
+        if isinstance(other, PieceSet):
+            return self._bits == other._bits
+        if isinstance(other, (set, frozenset)):
+            return set(self) == other
+        return NotImplemented
+
+    __hash__ = None  # mutable, like set
+
+    def issubset(self, other):
+        return self._bits & ~_bits_of(other) == 0
+
+    def issuperset(self, other):
+        return _bits_of(other) & ~self._bits == 0
+
+    def isdisjoint(self, other):
+        return self._bits & _bits_of(other) == 0
+
+    __le__ = issubset
+    __ge__ = issuperset
+
+    # Operators: the result is always a new PieceSet
+
+    def __and__(self, other):
+        try:
+            return PieceSet.from_bits(self._bits & _bits_of(other))
+        except TypeError:
+            return NotImplemented
+
+    def __or__(self, other):
+        try:
+            return PieceSet.from_bits(self._bits | _bits_of(other))
+        except TypeError:
+            return NotImplemented
+
+    def __sub__(self, other):
+        try:
+            return PieceSet.from_bits(self._bits & ~_bits_of(other))
+        except TypeError:
+            return NotImplemented
+
+    def __xor__(self, other):
+        try:
+            return PieceSet.from_bits(self._bits ^ _bits_of(other))
+        except TypeError:
+            return NotImplemented
+
+    __rand__ = __and__
+    __ror__ = __or__
+    __rxor__ = __xor__
+
+    def __rsub__(self, other):
+        try:
+            return PieceSet.from_bits(_bits_of(other) & ~self._bits)
+        except TypeError:
+            return NotImplemented
+
+    def intersection(self, *others):
+        bits = self._bits
+        for o in others:
+            bits &= _bits_of(o)
+        return PieceSet.from_bits(bits)
+
+    def union(self, *others):
+        bits = self._bits
+        for o in others:
+            bits |= _bits_of(o)
+        return PieceSet.from_bits(bits)
+
+    def difference(self, *others):
+        bits = self._bits
+        for o in others:
+            bits &= ~_bits_of(o)
+        return PieceSet.from_bits(bits)
+
+    def symmetric_difference(self, other):
+        return self ^ other
+
+    # Changing the set in place
+
+    def add(self, i):
+        self._bits |= 1 << operator.index(i)
+
+    def discard(self, i):
+        self._bits &= ~(1 << operator.index(i))
+
+    def copy(self):
+        return PieceSet.from_bits(self._bits)
+
+    def __reduce__(self):
+        return (PieceSet.from_bits, (self._bits,))
+
+    def __repr__(self):
+        if not self._bits:
+            return "PieceSet()"
+        return "PieceSet({%s})" % ", ".join(str(i) for i in self)
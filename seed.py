@@ -1,6 +1,5 @@
 #!/usr/bin/python
 
-import random
 from messages import Upload, Request
 from util import even_split
 from peer import Peer
@@ -12,13 +11,14 @@ class Seed(Peer):
 
     def uploads(self, requests, peers, history):
         max_upload = 4  # max num of peers to upload to at a time
-        requester_ids = list(set([r.requester_id for r in requests]))
+        # In request order (a set's order would depend on string hashing)
+        requester_ids = list(dict.fromkeys(r.requester_id for r in requests))
 
         n = min(max_upload, len(requester_ids))
         if n == 0:
             return []
         bws = even_split(self.up_bw, n)
         uploads = [Upload(self.id, p_id, bw)
-                   for (p_id, bw) in zip(random.sample(requester_ids, n), bws)]
+                   for (p_id, bw) in zip(self.rng.sample(requester_ids, n), bws)]
         
         return uploads
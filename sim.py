@@ -11,22 +11,37 @@ The simulation proceeds in rounds.  In each round, peers can request pieces from
 import re
 import random
 import sys
+import tempfile
 import logging
-import copy
-import itertools
+import multiprocessing
+import numbers
+import os
 import pprint
+import time
+import types
 from optparse import OptionParser
 
-from messages import Upload, Request, Download, PeerInfo
+from messages import Upload, Request, PeerInfo
 from util import *
 from stats import Stats
 from history import History
+from swarm import ENGINES, SwarmState, make_swarm_state, upload_rate_table
+from simcache import RunCache
+from timing import NullTimer, PhaseTimer
+from latency import CallLatencies, LatencyStats
+from agentpool import AgentPool
+from tracker import Tracker
 
 
 class Sim:
     def __init__(self, config):
         self.config = config
         self.up_bws_state = dict()
+        # The sim's own random stream (upload bandwidths); reseeded per run
+        self.rng = random.Random()
+        self.cache = None
+        if config.cache_dir:
+            self.cache = RunCache(config.cache_dir, config.cache_size * 2 ** 20)
 
     def up_bw(self, peer_id, reinit=False):
         """Return a consistent bw for this peer"""
@@ -37,360 +52,687 @@ class Sim:
         if reinit and peer_id in s:
             del s[peer_id]
 
-        """Sets the upload bandwidth of seeds to max, other agents at random"""
-        if re.match("Seed", peer_id):
-            the_up_bw = c.max_up_bw
-        else:
-            the_up_bw = random.randint(c.min_up_bw, c.max_up_bw)
-
-        return s.setdefault(peer_id, the_up_bw)
-
-    def run_sim_once(self):
-        """Return a history"""
+        """Sets the upload bandwidth of seeds to max, other agents at random.
+        Only draws a random number the first time it sees peer_id."""
+        if peer_id not in s:
+            if re.match("Seed", peer_id):
+                s[peer_id] = c.max_up_bw
+            else:
+                s[peer_id] = self.rng.randint(c.min_up_bw, c.max_up_bw)
+
+        return s[peer_id]
+
+    def make_peer_ids(self):
+        """Return the list of peer ids, one per agent class name, numbered
+        in order within each class: Seed0, Seed1, Dummy0, ..."""
+        counts = dict()
+
+        def index(name):
+            if name in counts:
+                a = counts[name]
+                counts[name] += 1
+            else:
+                a = 0
+                counts[name] = 1
+            return a
+
+        return ["%s%d" % (n, index(n)) for n in self.config.agent_class_names]
+
+    def iteration_seeds(self, start=0, stop=None):
+        """One derived seed per iteration, all from the base seed: those of
+        iterations start..stop-1, by default all --iters of them"""
+        if stop is None:
+            stop = self.config.iters
+        return [derive_seed(self.config.seed, "iter", i)
+                for i in range(start, stop)]
+
+    def history_log_dir(self, seed):
+        """Where --history-log keeps the history of the run with this seed"""
+        return os.path.join(self.config.history_log, "run-%016x" % seed)
+
+    def run_sim_once(self, seed=None, timer=None, latencies=None):
+        """Return a history.  If seed is given, reseed the random module
+        with it first so the run is reproducible.  If timer is given (see
+        timing.PhaseTimer), charge each phase of each round to it.  If
+        latencies is given (see latency.CallLatencies), record how long each
+        agent call takes in it."""
         conf = self.config
+        if timer is None:
+            timer = NullTimer()
+        if latencies is None and conf.call_budget:
+            # The budget is enforced whether or not anyone asked for the times
+            latencies = self.call_latencies()
+        clock = time.perf_counter
+        # The sim and every peer get their own stream, derived from the seed,
+        # so no draw depends on who else drew first.  The random module is
+        # still seeded for agents that use it directly.
+        self.rng = seeded_rng(seed, "sim")
+        if seed is not None:
+            random.seed(seed)
         # Keep track of the current round.  Needs to be in scope for helpers.
         round = 0
 
-        def check_pred(pred, msg, Exc, lst):
-            """Check if any element of lst matches the predicate.  If it does,
-            raise an exception of type Exc, including the msg and the offending
-            element."""
-            m = list(map(pred, lst))
-            if True in m:
-                i = m.index(True)
-                raise Exc(msg + " Bad element: %s" % lst[i])
-
-        def check_uploads(peer, uploads):
-            """Raise an IllegalUpload exception if there is a problem."""
-
-            def check(pred, msg):
-                check_pred(pred, msg, IllegalUpload, uploads)
-
-            not_upload = lambda o: not isinstance(o, Upload)
-            check(not_upload, "List of Uploads contains non-Upload object.")
-
-            self_upload = lambda upload: upload.to_id == peer.id
-            check(self_upload, "Can't upload to yourself.")
-
-            not_from_self = lambda upload: upload.from_id != peer.id
-            check(not_from_self, "Upload.from != peer id.")
-
-            check(lambda u: u.bw < 0, "Upload bandwidth must be non-negative!")
-
-            limit = self.up_bw(peer.id)
-            if sum([u.bw for u in uploads]) > limit:
+        # Validation: "full" checks every message, "sampled" checks a
+        # random fraction of the message lists (with its own random stream,
+        # so the run is the same either way), "trusted" checks nothing.
+        validate_rng = seeded_rng(seed, "validate")
+
+        def should_check():
+            if conf.validate == "full":
+                return True
+            elif conf.validate == "sampled":
+                return validate_rng.random() < conf.validate_fraction
+            return False
+
+        def bad(Exc, msg, element):
+            raise Exc(msg + " Bad element: %s" % element)
+
+        def check_uploads(peer_id, uploads):
+            """Raise an IllegalUpload exception if there is a problem.
+            One pass over the uploads."""
+            if not should_check():
+                return
+            total = 0
+            for u in uploads:
+                if not isinstance(u, Upload):
+                    bad(IllegalUpload, "List of Uploads contains non-Upload object.", u)
+                if u.to_id == peer_id:
+                    bad(IllegalUpload, "Can't upload to yourself.", u)
+                if u.from_id != peer_id:
+                    bad(IllegalUpload, "Upload.from != peer id.", u)
+                if u.bw < 0:
+                    bad(IllegalUpload, "Upload bandwidth must be non-negative!", u)
+                total += u.bw
+
+            limit = self.up_bws_state[peer_id]
+            if total > limit:
                 raise IllegalUpload("Can't upload more than limit of %d. Attempted to upload %s, for uploads: %s" % (
-                    limit, sum([u.bw for u in uploads]), uploads))
+                    limit, total, uploads))
 
             # If we got here, looks ok.
 
-        def check_requests(peer, requests, peer_pieces, available):
-            """Raise an IllegalRequest exception if there is a problem."""
-
-            def check(pred, msg):
-                check_pred(pred, msg, IllegalRequest, requests)
-
-            check(lambda o: not isinstance(o, Request),
-                  "List of Requests contains non-Request object.")
+        def whole_blocks(uploads):
+            """uploads with each bw rounded down to whole blocks, as the
+            swarm and the history store them.  Agents may upload a float,
+            such as up_bw / 2."""
+            for u in uploads:
+                if type(u.bw) is not int:
+                    return [Upload(u.from_id, u.to_id, int(u.bw))
+                            if type(u.bw) is not int else u for u in uploads]
+            return uploads
+
+        def check_requests(peer_id, requests, state):
+            """Raise an IllegalRequest exception if there is a problem.
+            One pass over the requests."""
+            if not should_check():
+                return
+            num_pieces = conf.num_pieces
+            blocks_per_piece = conf.blocks_per_piece
+            for r in requests:
+                if not isinstance(r, Request):
+                    bad(IllegalRequest, "List of Requests contains non-Request object.", r)
+                if not (isinstance(r.piece_id, numbers.Integral) and
+                        isinstance(r.start, numbers.Integral)):
+                    bad(IllegalRequest, "Request piece and start block must be ints!", r)
+                if r.piece_id < 0 or r.piece_id >= num_pieces:
+                    bad(IllegalRequest, "Request asks for non-existent piece!", r)
+                if r.peer_id not in state.index:
+                    bad(IllegalRequest, "Request mentions non-existent peer!", r)
+                if tracker is not None and not tracker.are_neighbors(peer_id, r.peer_id):
+                    bad(IllegalRequest, "Request to a peer that isn't a neighbor!", r)
+                if r.requester_id != peer_id:
+                    bad(IllegalRequest, "Request has wrong peer id!", r)
+                # Must request the _next_ necessary block
+                if (r.start < 0 or r.start >= blocks_per_piece or
+                        r.start > state.blocks(peer_id, r.piece_id)):
+                    bad(IllegalRequest, "Request has bad start block!", r)
+                if not state.available_map[r.peer_id][r.piece_id]:
+                    bad(IllegalRequest, "Asking for piece peer does not have!", r)
 
-            bad_piece_id = lambda r: (r.piece_id < 0 or
-                                      r.piece_id >= self.config.num_pieces)
-            check(bad_piece_id, "Request asks for non-existent piece!")
-
-            bad_peer_id = lambda r: r.peer_id not in self.peer_ids
-            check(bad_peer_id, "Request mentions non-existent peer!")
-
-            bad_requester_id = lambda r: r.requester_id != peer.id
-            check(bad_requester_id, "Request has wrong peer id!")
-
-            bad_start_block = lambda r: (
-                    r.start < 0 or
-                    r.start >= self.config.blocks_per_piece or
-                    r.start > peer_pieces[peer.id][r.piece_id])
-            # Must request the _next_ necessary block
-            check(bad_start_block, "Request has bad start block!")
+            # If we got here, looks ok
 
-            def piece_peer_does_not_have(r):
-                other_peer = self.peers_by_id[r.peer_id]
-                return r.piece_id not in available[other_peer.id]
+        def all_done(state):
+            # Only peers that finished a piece this round can have become done
+            for peer_id in state.newly_done():
+                history.peer_is_done(round, peer_id)
+            return state.all_done()
 
-            check(piece_peer_does_not_have, "Asking for piece peer does not have!")
+        def peer_specs():
+            """(class name, id, pieces, up bw, random stream) for each peer"""
+            ids = self.make_peer_ids()
 
-            # If we got here, looks ok
+            pieces = [SwarmState.initial_pieces(conf, id) for id in ids]
 
-        def available_pieces(peer_id, peer_pieces):
-            """
-            Return a list of piece ids that this peer has available.
-            """
-            return [i for i in range(conf.num_pieces) if peer_pieces[peer_id][i] == conf.blocks_per_piece]
-
-        def peer_done(peer_pieces, peer_id):
-            # TODO: remove linear pass
-            for blocks_so_far in peer_pieces[peer_id]:
-                if blocks_so_far < conf.blocks_per_piece:
-                    return False
-            return True
-
-        def all_done(peer_pieces):
-            result = True
-            # Check all peers to update done status
-            for peer_id in peer_pieces:
-                if peer_done(peer_pieces, peer_id):
-                    history.peer_is_done(round, peer_id)
-                else:
-                    result = False
-            return result
+            # Re-initialize upload bandwidths at the beginning of each
+            # new simulation
+            up_bws = [self.up_bw(id, reinit=True) for id in ids]
+            rngs = [seeded_rng(seed, "peer", id) for id in ids]
+            return list(zip(conf.agent_class_names, ids, pieces, up_bws, rngs))
 
-        def create_peers():
+        def create_peers(specs):
             """Each agent class must be already loaded, and have a
             constructor that takes the config, id,  pieces, and
-            up and down bandwidth, in that order."""
+            up and down bandwidth, in that order, and optionally its
+            random stream."""
 
             def load(class_name, params):
                 agent_class = conf.agent_classes[class_name]
                 return agent_class(*params)
 
-            counts = dict()
-
-            def index(name):
-                if name in counts:
-                    a = counts[name]
-                    counts[name] += 1
-                else:
-                    a = 0
-                    counts[name] = 1
-                return a
-
-            n = len(conf.agent_class_names)
-            ids = ["%s%d" % (n, index(n)) for n in conf.agent_class_names]
-
-            is_seed = lambda id: id.startswith("Seed")
-
-            def get_pieces(id):
-                if id.startswith("Seed"):
-                    return [conf.blocks_per_piece] * conf.num_pieces
-                else:
-                    return [0] * conf.num_pieces
-
-            peer_pieces = dict()  # id -> list (blocks / piece)
-            peer_pieces = dict((id, get_pieces(id)) for id in ids)
-            pieces = [get_pieces(id) for id in ids]
-            r = itertools.repeat
-
-            # Re-initialize upload bandwidths at the beginning of each
-            # new simulation
-            up_bws = [self.up_bw(id, reinit=True) for id in ids]
-            params = list(zip(r(conf), ids, pieces, up_bws))
+            params = [(conf, id, pieces, up_bw, rng)
+                      for (name, id, pieces, up_bw, rng) in specs]
 
             peers = list(map(load, conf.agent_class_names, params))
             # logging.debug("Peers: \n" + "\n".join(str(p) for p in peers))
-            return peers, peer_pieces
-
-        def get_peer_requests(p, peer_info, peer_history, peer_pieces, available):
-            def remove_me(info):
-                # TODO: Do we need this linear pass?
-                return [peer for peer in peer_info if peer.id != p.id]
-
-            pieces = copy.copy(peer_pieces[p.id])
-            # Made copy of pieces and the peer info this peer needs to make it's
-            # decision, so that it can't change the simulation's copies.
+            return peers
+
+        def visible_to(peer_id, peer_info, info_by_id):
+            """The PeerInfo peer_id gets to see: everyone else's, or with a
+            tracker just its neighbors'"""
+            if tracker is None:
+                return [info for info in peer_info if info.id != peer_id]
+            return [info_by_id[n] for n in tracker.neighbors(peer_id)]
+
+        def get_peer_requests(p, others, peer_history, state,
+                              availability_view):
+            pieces = state.pieces(p.id)
+            # Pieces and the peer info are read-only views, so that the peer
+            # can't change the simulation's copies.
             p.update_pieces(pieces)
-            rs = p.requests(remove_me(peer_info), peer_history)
-            check_requests(p, rs, peer_pieces, available)
+            p.update_availability(availability_view)
+            if latencies is None:
+                rs = p.requests(others, peer_history)
+            else:
+                start = clock()
+                rs = p.requests(others, peer_history)
+                if latencies.record("requests", p.__class__.__name__, p.id,
+                                    clock() - start):
+                    rs = []
+            timer.lap("requests")
+            check_requests(p.id, rs, state)
+            timer.lap("check_requests")
             return rs
 
-        def get_peer_uploads(all_requests, p, peer_info, peer_history):
-            def remove_me(info):
-                # TODO: remove this pass?  Use a set?
-                return [peer for peer in peer_info if peer.id != p.id]
-
-            def requests_to(id):
-                f = lambda r: r.peer_id == id
-                ans = []
-                for rs in list(all_requests.values()):
-                    ans.extend(list(filter(f, rs)))
-                return ans
-
-            requests = requests_to(p.id)
-
-            us = p.uploads(requests, remove_me(peer_info), peer_history)
-            check_uploads(p, us)
-            return us
-
-        def upload_rate(uploads, uploader_id, requester_id):
-            """
-            return the uploading rate from uploader to requester
-            in blocks per time period, or 0 if not uploading.
-            """
-            for u in uploads[uploader_id]:
-                if u.to_id == requester_id:
-                    return u.bw
-            return 0
-
-        def update_peer_pieces(peer_pieces, requests, uploads, available):
-            """
-            Process the uploads: figure out how many blocks of all the requested
-            pieces the requesters ended up with.
-            Make sure requesting the same thing from lots of peers doesn't
-            stack.
-            update the sets of available pieces as needed.
-            """
-            downloads = dict()  # peer_id -> [downloads]
-            new_pp = copy.deepcopy(peer_pieces)
-            for requester_id in requests:
-                downloads[requester_id] = list()
-            for requester_id in requests:
-                # Keep track of how many blocks of each piece this
-                # requester got.  piece -> (blocks, from_who)
-                new_blocks_per_piece = dict()
-
-                def update_count(piece_id, blocks, peer_id):
-                    if piece_id in new_blocks_per_piece:
-                        old = new_blocks_per_piece[piece_id][0]
-                        if blocks > old:
-                            new_blocks_per_piece[piece_id] = (blocks, peer_id)
-                    else:
-                        new_blocks_per_piece[piece_id] = (blocks, peer_id)
-
-                # Group the requests by peer that is being asked
-                get_peer_id = lambda r: r.peer_id
-                rs = sorted(requests[requester_id], key=get_peer_id)
-                for peer_id, rs_for_peer in itertools.groupby(rs, get_peer_id):
-                    bw = upload_rate(uploads, peer_id, requester_id)
-                    if bw == 0:
-                        continue
-                    # This bandwidth gets applied in order to each piece requested
-                    for r in rs_for_peer:
-                        needed_blocks = conf.blocks_per_piece - r.start
-                        alloced_bw = min(bw, needed_blocks)
-                        update_count(r.piece_id, alloced_bw, peer_id)
-                        bw -= alloced_bw
-                        if bw == 0:
-                            break
-                for piece_id in new_blocks_per_piece:
-                    (blocks, peer_id) = new_blocks_per_piece[piece_id]
-                    new_pp[requester_id][piece_id] += blocks
-                    if new_pp[requester_id][piece_id] == conf.blocks_per_piece:
-                        available[requester_id].add(piece_id)
-                    d = Download(peer_id, requester_id, piece_id, blocks)
-                    downloads[requester_id].append(d)
-
-            return (new_pp, downloads)
-
-        def completed_pieces(peer_id, available):
-            return len(available[peer_id])
-
-        def log_peer_info(peer_pieces, available):
-            for p_id in self.peer_ids:
-                pieces = peer_pieces[p_id]
-                logging.debug("pieces for %s: %s" % (str(p_id), str(pieces)))
-            log = ", ".join("%s:%s" % (p_id, completed_pieces(p_id, available))
+        def get_peer_uploads(requests, p, others, peer_history):
+            """requests: the requests made to p this round"""
+            if latencies is None:
+                us = p.uploads(requests, others, peer_history)
+            else:
+                start = clock()
+                us = p.uploads(requests, others, peer_history)
+                if latencies.record("uploads", p.__class__.__name__, p.id,
+                                    clock() - start):
+                    us = []
+            timer.lap("uploads")
+            check_uploads(p.id, us)
+            timer.lap("check_uploads")
+            return whole_blocks(us)
+
+        # The active set: which peers get called this round (see
+        # Peer.every_round)
+        every_round = set(pid for (name, pid)
+                          in zip(conf.agent_class_names, self.make_peer_ids())
+                          if conf.agent_classes[name].every_round)
+
+        def is_done(peer_id):
+            """Skip peer_id's requests(): it has everything"""
+            return peer_id not in every_round and state.peer_done(peer_id)
+
+        def is_idle(peer_id, requests_to):
+            """Skip peer_id's uploads(): nobody asked it for anything"""
+            return peer_id not in every_round and not requests_to[peer_id]
+
+        def pool_requests(peer_info, state, neighbors):
+            """Every peer's requests, from the agents in the pool.
+            neighbors: the tracker's new neighbor lists, if they changed"""
+            pieces = dict((pid, list(state.pieces(pid))) for pid in self.peer_ids
+                          if not is_done(pid))
+            replies = pool.requests(peer_info, dict(state.availability), pieces,
+                                    neighbors)
+            timer.lap("requests")
+            requests = dict()
+            for (name, pid) in zip(conf.agent_class_names, self.peer_ids):
+                if pid not in replies:
+                    requests[pid] = []
+                    continue
+                (rs, seconds) = replies[pid]
+                if latencies is not None and latencies.record(
+                        "requests", name, pid, seconds):
+                    rs = []
+                check_requests(pid, rs, state)
+                requests[pid] = rs
+            timer.lap("check_requests")
+            return requests
+
+        def pool_uploads(requests_to):
+            """Every peer's uploads, from the agents in the pool"""
+            replies = pool.uploads(dict((pid, rs) for (pid, rs) in requests_to.items()
+                                        if not is_idle(pid, requests_to)))
+            timer.lap("uploads")
+            uploads = dict()
+            for (name, pid) in zip(conf.agent_class_names, self.peer_ids):
+                if pid not in replies:
+                    uploads[pid] = []
+                    continue
+                (us, seconds) = replies[pid]
+                if latencies is not None and latencies.record(
+                        "uploads", name, pid, seconds):
+                    us = []
+                check_uploads(pid, us)
+                uploads[pid] = whole_blocks(us)
+            timer.lap("check_uploads")
+            return uploads
+
+        def log_peer_info(state):
+            if debug_on:
+                for p_id in self.peer_ids:
+                    logging.debug("pieces for %s: %s", p_id, state.pieces(p_id))
+            log = ", ".join("%s:%s" % (p_id, state.completed_pieces(p_id))
                             for p_id in self.peer_ids)
-            logging.info("Pieces completed: " + log)
+            logging.info("Pieces completed: %s", log)
 
-        logging.debug("Starting simulation with config: %s" % str(conf))
+        # Decide once per run whether to render anything: building the
+        # per-round strings is most of the cost of logging.
+        logger = logging.getLogger()
+        debug_on = not conf.quiet and logger.isEnabledFor(logging.DEBUG)
+        info_on = not conf.quiet and logger.isEnabledFor(logging.INFO)
 
-        peers, peer_pieces = create_peers()
-        self.peer_ids = [p.id for p in peers]
-        self.peers_by_id = dict((p.id, p) for p in peers)
+        logging.debug("Starting simulation with config: %s", conf)
 
+        specs = peer_specs()
+        self.peer_ids = [spec[1] for spec in specs]
         upload_rates = dict((id, self.up_bw(id)) for id in self.peer_ids)
-        history = History(self.peer_ids, upload_rates)
 
-        # dict : pid -> set(finished / available pieces)
-        available = dict((pid, set(available_pieces(pid, peer_pieces)))
-                         for pid in self.peer_ids)
+        # With --neighbors, a tracker limits who each peer sees and can
+        # request from
+        tracker = None
+        if conf.neighbors:
+            tracker = Tracker(self.peer_ids, conf.neighbors,
+                              conf.neighbor_refresh, seeded_rng(seed, "tracker"))
+
+        # The agents either live here, or in worker processes that decide
+        # for them in parallel (--decision-workers)
+        pool = None
+        if conf.decision_workers > 1:
+            pool_seed = None if seed is None else derive_seed(seed, "agents")
+            pool = AgentPool(conf, specs, upload_rates,
+                             min(conf.decision_workers, len(specs)), pool_seed)
+        else:
+            peers = create_peers(specs)
+
+        log_dir = None
+        if conf.history_log:
+            if seed is None:
+                log_dir = tempfile.mkdtemp(prefix="run-", dir=conf.history_log)
+            else:
+                log_dir = self.history_log_dir(seed)
+                try:
+                    os.makedirs(log_dir)
+                except FileExistsError:
+                    raise FileExistsError(
+                        "%s already holds the history of a run with seed %d: "
+                        "remove it, or use another --history-log directory"
+                        % (log_dir, seed))
+        history = History(self.peer_ids, upload_rates, log_dir)
+
+        # Who has what.  Keeps the available piece sets and the per-piece
+        # availability counts up to date.  Agents get a read-only view
+        # of the counts.
+        state = make_swarm_state(conf, self.peer_ids)
+        availability_view = types.MappingProxyType(state.availability)
 
         # Begin the event loop
-        while True:
-            logging.info("======= Round %d ========" % round)
-
-            peer_info = [PeerInfo(p.id, available[p.id])
-                         for p in peers]
-            requests = dict()  # peer_id -> list of Requests
-            uploads = dict()  # peer_id -> list of Uploads
-            h = dict()
-            for p in peers:
-                h[p.id] = history.peer_history(p.id)
-                requests[p.id] = get_peer_requests(p, peer_info, h[p.id], peer_pieces,
-                                                   available)
-
-            for p in peers:
-                uploads[p.id] = get_peer_uploads(requests, p, peer_info, h[p.id])
-
-            (peer_pieces, downloads) = update_peer_pieces(
-                peer_pieces, requests, uploads, available)
-            history.update(downloads, uploads)
-
-            logging.debug(history.pretty_for_round(round))
+        try:
+            while True:
+                timer.round()
+                if info_on:
+                    logging.info("======= Round %d ========", round)
+                timer.lap("logging")
+
+                peer_info = [PeerInfo(pid, state.available_view(pid))
+                             for pid in self.peer_ids]
+                info_by_id = None
+                new_neighbors = False
+                if tracker is not None:
+                    new_neighbors = tracker.round(round)
+                    info_by_id = dict(zip(self.peer_ids, peer_info))
+                    timer.lap("neighbors")
+                # peer_id -> list of Requests _to_ that peer, in peers order
+                requests_to = dict((pid, []) for pid in self.peer_ids)
+                if pool is None:
+                    requests = dict()  # peer_id -> list of Requests
+                    uploads = dict()  # peer_id -> list of Uploads
+                    for p in peers:
+                        if is_done(p.id):
+                            requests[p.id] = []
+                            continue
+                        requests[p.id] = get_peer_requests(
+                            p, visible_to(p.id, peer_info, info_by_id),
+                            history.peer_history(p.id), state,
+                            availability_view)
+                        for r in requests[p.id]:
+                            requests_to[r.peer_id].append(r)
+                    timer.lap("requests")
+
+                    for p in peers:
+                        if is_idle(p.id, requests_to):
+                            uploads[p.id] = []
+                            continue
+                        uploads[p.id] = get_peer_uploads(
+                            requests_to[p.id], p,
+                            visible_to(p.id, peer_info, info_by_id),
+                            history.peer_history(p.id))
+                    timer.lap("uploads")
+                else:
+                    neighbors = None
+                    if new_neighbors:
+                        neighbors = dict((pid, tracker.neighbors(pid))
+                                         for pid in self.peer_ids)
+                    requests = pool_requests(peer_info, state, neighbors)
+                    for pid in self.peer_ids:
+                        for r in requests[pid]:
+                            requests_to[r.peer_id].append(r)
+                    uploads = pool_uploads(requests_to)
+
+                rates = upload_rate_table(uploads)
+                downloads = state.apply_round(requests, rates)
+                timer.lap("apply_round")
+                history.update(downloads, uploads)
+                if pool is not None:
+                    pool.update(downloads, uploads)
+                timer.lap("history")
+
+                if debug_on:
+                    logging.debug(history.pretty_for_round(round))
+
+                if info_on:
+                    log_peer_info(state)
+                timer.lap("logging")
+
+                done = all_done(state)
+                timer.lap("done_check")
+                timer.end_round()
+                if done:
+                    if info_on:
+                        logging.info("All done!")
+                    break
+                round += 1
+                if round > conf.max_round:
+                    if info_on:
+                        logging.info("Out of time.  Stopping.")
+                    break
+        finally:
+            if pool is not None:
+                pool.close()
+
+        if log_dir:
+            history.write_meta()
+            logging.info("History logged to %s", log_dir)
+
+        if info_on:
+            logging.info("Game history:\n%s", history.pretty())
+
+            logging.info("======== STATS ========")
+            logging.info("Uploaded blocks:\n%s",
+                         Stats.uploaded_blocks_str(self.peer_ids, history))
+            logging.info("Completion rounds:\n%s",
+                         Stats.completion_rounds_str(self.peer_ids, history))
+            logging.info("All done round: %s",
+                         Stats.all_done_round(self.peer_ids, history))
 
-            log_peer_info(peer_pieces, available)
+        return history
 
-            if all_done(peer_pieces):
-                logging.info("All done!")
-                break
-            round += 1
-            if round > conf.max_round:
-                logging.info("Out of time.  Stopping.")
+    def run_iteration(self, seed):
+        """Run one seeded simulation and return just its summary:
+        (uploaded blocks dict, completion rounds dict)"""
+        return self.cached_run(seed)[1]
+
+    def cached_run(self, seed):
+        """Like run_sim_once, but returns (history, summary) and, with
+        --cache-dir, reuses a stored result for the same config, seed and
+        code instead of simulating again"""
+        self.peer_ids = self.make_peer_ids()
+        # Runs logged to disk are already kept there, and penalized runs
+        # depend on how fast the machine is
+        conf = self.config
+        use_cache = (self.cache and not conf.history_log and
+                     not (conf.call_budget and conf.over_budget == "penalize"))
+        if use_cache:
+            key = self.cache.key(self.config, seed)
+            entry = self.cache.get(key)
+            if entry is not None:
+                logging.debug("Cached run %s", key)
+                return entry
+
+        history = self.run_sim_once(seed)
+        summary = (Stats.uploaded_blocks(self.peer_ids, history),
+                   Stats.completion_rounds(self.peer_ids, history))
+        # Only store runs whose every message was checked: an unchecked one
+        # may have done what a checked run would have rejected.  A checked
+        # run is what any --validate setting would have got, so those are
+        # good for all of them.
+        if use_cache and conf.validate == "full":
+            self.cache.put(key, (history, summary))
+        return (history, summary)
+
+    def call_latencies(self):
+        conf = self.config
+        budget = None
+        if conf.call_budget:
+            budget = conf.call_budget / 1000.0
+        return CallLatencies(budget, conf.over_budget == "penalize")
+
+    def measured_iteration(self, seed):
+        """Like run_iteration, but always simulates, and returns
+        (summary, timer, latencies): the timing.PhaseTimer and
+        latency.CallLatencies for the run, or None when not asked for"""
+        conf = self.config
+        self.peer_ids = self.make_peer_ids()
+        timer = None
+        if conf.timings or conf.timings_json:
+            timer = PhaseTimer(keep_rounds=bool(conf.timings_json))
+        latencies = None
+        if conf.latency or conf.call_budget:
+            latencies = self.call_latencies()
+        history = self.run_sim_once(seed, timer, latencies)
+        summary = (Stats.uploaded_blocks(self.peer_ids, history),
+                   Stats.completion_rounds(self.peer_ids, history))
+        return (summary, timer, latencies)
+
+    def report_timings(self, timer):
+        """Log the --timings table for the merged timer of all runs"""
+        logging.warning("======== TIMINGS ========")
+        for line in timer.table():
+            logging.warning(line)
+
+    def report_latencies(self, latencies):
+        """Log the --latency tables and who went over --call-budget, for
+        the latency.LatencyStats of all runs"""
+        conf = self.config
+        if conf.latency:
+            logging.warning("======== AGENT CALL TIMES ========")
+            for line in latencies.table():
+                logging.warning(line)
+            logging.warning("")
+            for line in latencies.table(by_peer=True):
+                logging.warning(line)
+        over = latencies.over_budget()
+        if over:
+            logging.warning("Over the %g ms call budget%s:" % (
+                conf.call_budget,
+                " (output dropped)" if conf.over_budget == "penalize" else ""))
+            for line in over:
+                logging.warning("  " + line)
+
+    def ci_widths(self):
+        """The widest confidence interval, over all peers, on mean uploaded
+        blocks and on mean completion round, for the iterations so far"""
+        widest_up = 0.0
+        widest_rounds = 0.0
+        for p_id in self.peer_ids:
+            widest_up = max(widest_up, self.uploaded_stats[p_id].ci_width())
+            cs = self.completion_stats[p_id]
+            if cs.missing == 0:
+                widest_rounds = max(widest_rounds, cs.ci_width())
+            elif cs.n > 0:
+                # Finished in some runs only: no mean to converge on yet
+                widest_rounds = float("inf")
+        return (widest_up, widest_rounds)
+
+    def run_until_converged(self, run_batch):
+        """Run --iters (and at least --min-iters) iterations, then more, a
+        batch at a time, until the confidence intervals are narrower than
+        --ci-width or there have been --max-iters.  Iteration i has the same seed as without --ci-width.
+        Returns the number of iterations run."""
+        conf = self.config
+        batch = max(conf.workers, 1)
+        done = 0
+        stop = min(max(conf.iters, conf.min_iters), conf.max_iters)
+        while True:
+            run_batch(done, stop)
+            done = stop
+            (up, rounds) = self.ci_widths()
+            logging.info("%d iterations: CI widths %.2f blocks, %.2f rounds",
+                         done, up, rounds)
+            if max(up, rounds) <= conf.ci_width or done >= conf.max_iters:
                 break
-
-        logging.info("Game history:\n%s" % history.pretty())
-
-        logging.info("======== STATS ========")
-        logging.info("Uploaded blocks:\n%s" %
-                     Stats.uploaded_blocks_str(self.peer_ids, history))
-        logging.info("Completion rounds:\n%s" %
-                     Stats.completion_rounds_str(self.peer_ids, history))
-        logging.info("All done round: %s" %
-                     Stats.all_done_round(self.peer_ids, history))
-
-        return history
+            stop = min(done + batch, conf.max_iters)
+        logging.warning("Stopped after %d iterations; widest 95%% CIs: "
+                        "%.2f uploaded blocks, %.2f completion rounds (target %g)" % (
+                            done, up, rounds, conf.ci_width))
+        return done
 
     def run_sim(self):
-        histories = [self.run_sim_once() for i in range(self.config.iters)]
-        logging.warning("======== SUMMARY STATS ========")
-
-        uploaded_blocks = [Stats.uploaded_blocks(self.peer_ids, h) for h in histories]
-        completion_rounds = [Stats.completion_rounds(self.peer_ids, h) for h in histories]
-
-        def extract_by_peer_id(lst, peer_id):
-            """Given a list of dicts, pull out the entry
-            for peer_id from each dict.  Return a list"""
-            return [d[peer_id] for d in lst]
+        self.peer_ids = self.make_peer_ids()
+        conf = self.config
+        timed = conf.timings or conf.timings_json
+        measured = timed or conf.latency or conf.call_budget
+        run = self.measured_iteration if measured else self.run_iteration
+
+        # Uploaded blocks and completion rounds, per peer and per agent
+        # class (util.RunningStats).  Each iteration's results go into them
+        # as soon as it finishes, and are then dropped.
+        classes = dict(zip(self.peer_ids, conf.agent_class_names))
+        self.uploaded_stats = dict((pid, RunningStats()) for pid in self.peer_ids)
+        self.completion_stats = dict((pid, RunningStats()) for pid in self.peer_ids)
+        self.class_uploaded_stats = dict((name, RunningStats())
+                                         for name in conf.agent_class_names)
+        self.class_completion_stats = dict((name, RunningStats())
+                                           for name in conf.agent_class_names)
+        # Timers merge; call times only go into streaming estimates, so
+        # memory doesn't grow with the number of iterations
+        merged = dict(timer=None)
+        latency_stats = LatencyStats()
+
+        timings_file = None
+        if conf.timings_json:
+            timings_file = open(conf.timings_json, "w")
+
+        def add(i, seed, result):
+            if measured:
+                (summary, timer, latencies) = result
+                if timer is not None:
+                    if merged["timer"] is None:
+                        merged["timer"] = timer
+                    else:
+                        merged["timer"].merge(timer)
+                if latencies is not None:
+                    latency_stats.add(latencies)
+                if timings_file is not None:
+                    timer.write_rounds(timings_file, run=i, seed=seed)
+                    timer.by_round = None
+            else:
+                summary = result
+            (uploaded, completion) = summary
+            for pid in self.peer_ids:
+                self.uploaded_stats[pid].add(uploaded[pid])
+                self.completion_stats[pid].add(completion[pid])
+                self.class_uploaded_stats[classes[pid]].add(uploaded[pid])
+                self.class_completion_stats[classes[pid]].add(completion[pid])
+
+        pool = None
+        if conf.workers > 1 and (conf.iters > 1 or conf.ci_width):
+            pool = multiprocessing.Pool(conf.workers)
+
+        def run_batch(start, stop):
+            """Run iterations start..stop-1"""
+            seeds = self.iteration_seeds(start, stop)
+            if pool is None:
+                results = map(run, seeds)
+            else:
+                # In seed order, whatever the worker count
+                results = pool.imap(run, seeds)
+            for (i, (seed, result)) in enumerate(zip(seeds, results), start):
+                add(i, seed, result)
 
-        uploaded_by_id = dict(
-            (p_id, extract_by_peer_id(uploaded_blocks, p_id))
-            for p_id in self.peer_ids)
+        try:
+            if conf.ci_width:
+                self.run_until_converged(run_batch)
+            else:
+                run_batch(0, conf.iters)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+            if timings_file is not None:
+                timings_file.close()
+
+        if conf.timings:
+            self.report_timings(merged["timer"])
+        if conf.latency or conf.call_budget:
+            self.report_latencies(latency_stats)
+        logging.warning("======== SUMMARY STATS ========")
 
-        completion_by_id = dict(
-            (p_id, extract_by_peer_id(completion_rounds, p_id))
-            for p_id in self.peer_ids)
+        uploaded_by_id = self.uploaded_stats
+        completion_by_id = self.completion_stats
 
         logging.warning("Uploaded blocks: avg (stddev)")
         for p_id in sorted(self.peer_ids,
-                           key=lambda id: mean(uploaded_by_id[id])):
+                           key=lambda id: uploaded_by_id[id].mean()):
             us = uploaded_by_id[p_id]
-            logging.warning("%s: %.1f  (%.1f)" % (p_id, mean(us), stddev(us)))
+            logging.warning("%s: %.1f  (%.1f)" % (p_id, us.mean(), us.stddev()))
 
         logging.warning("Completion rounds: avg (stddev)")
 
         def optionize(f):
-            def g(lst):
-                if None in lst:
+            def g(stats):
+                if stats.missing:
                     return None
                 else:
-                    return f(lst)
+                    return f(stats)
 
             return g
 
-        opt_mean = optionize(mean)
-        opt_stddev = optionize(stddev)
+        opt_mean = optionize(RunningStats.mean)
+        opt_stddev = optionize(RunningStats.stddev)
 
         for p_id in sorted(self.peer_ids,
                            key=lambda id: opt_mean(completion_by_id[id]) or 0):
             cs = completion_by_id[p_id]
             logging.warning("%s: %s  (%s)" % (p_id, opt_mean(cs), opt_stddev(cs)))
 
+        logging.warning("By agent class: avg (stddev)  min / p50 / p90 / max")
+        names = sorted(self.class_uploaded_stats)
+        logging.warning("Uploaded blocks:")
+        for name in names:
+            logging.warning("%s: %s" % (name, self.describe(self.class_uploaded_stats[name])))
+        logging.warning("Completion rounds:")
+        for name in names:
+            logging.warning("%s: %s" % (name, self.describe(self.class_completion_stats[name])))
+
+    @staticmethod
+    def describe(stats):
+        """One line summing up a RunningStats"""
+        if stats.n == 0:
+            return "never (%d runs)" % stats.missing
+        line = "%.1f  (%.1f)  %s / %.1f / %.1f / %s" % (
+            stats.mean(), stats.stddev(), stats.min, stats.quantile(0.5),
+            stats.quantile(0.9), stats.max)
+        if stats.missing:
+            line += "  (unfinished in %d of %d)" % (stats.missing,
+                                                    stats.n + stats.missing)
+        return line
+
 
 def configure_logging(loglevel):
     numeric_level = getattr(logging, loglevel.upper(), None)
@@ -425,19 +767,18 @@ def parse_agents(args):
     return ans
 
 
-def main(args):
+def make_parser():
     usage_msg = "Usage:  %prog [options] PeerClass1[,count] PeerClass2[,count] ..."
     parser = OptionParser(usage=usage_msg)
 
-    def usage(msg):
-        print(("Error: %s\n" % msg))
-        parser.print_help()
-        sys.exit()
-
     parser.add_option("--loglevel",
                       dest="loglevel", default="info",
                       help="Set the logging level: 'debug' or 'info'")
 
+    parser.add_option("--quiet",
+                      dest="quiet", default=False, action="store_true",
+                      help="Benchmark mode: no per-round logging at all, just the summary")
+
     parser.add_option("--num-pieces",
                       dest="num_pieces", default=3, type="int",
                       help="Set number of pieces in the file")
@@ -462,6 +803,142 @@ def main(args):
                       dest="iters", default=1, type="int",
                       help="Number of times to run simulation to get stats")
 
+    parser.add_option("--ci-width",
+                      dest="ci_width", default=None, type="float",
+                      help="Keep running iterations (--iters at least) until the 95%% confidence interval on every peer's mean uploaded blocks and completion round is narrower than this")
+
+    parser.add_option("--min-iters",
+                      dest="min_iters", default=10, type="int",
+                      help="With --ci-width, run at least this many iterations before testing the confidence intervals")
+
+    parser.add_option("--max-iters",
+                      dest="max_iters", default=1000, type="int",
+                      help="With --ci-width, stop after this many iterations regardless")
+
+    parser.add_option("--engine",
+                      dest="engine", default="dict", choices=ENGINES,
+                      help="Swarm state engine: 'dict' or 'numpy' (needs numpy)")
+
+    parser.add_option("--neighbors",
+                      dest="neighbors", default=0, type="int",
+                      help="Have a tracker give each peer this many neighbors to see and request from, instead of the whole swarm (0, the default, means everyone)")
+
+    parser.add_option("--neighbor-refresh",
+                      dest="neighbor_refresh", default=0, type="int",
+                      help="With --neighbors, draw new neighbors every this many rounds (0, the default, keeps them for the whole run)")
+
+    parser.add_option("--history-log",
+                      dest="history_log", default=None,
+                      help="Log each run's history to a directory under this one, instead of keeping it in memory")
+
+    parser.add_option("--validate",
+                      dest="validate", default="full",
+                      choices=["full", "sampled", "trusted"],
+                      help="Check agents' messages: 'full' (default), 'sampled' or 'trusted' (no checks)")
+
+    parser.add_option("--validate-fraction",
+                      dest="validate_fraction", default=0.1, type="float",
+                      help="With --validate=sampled, fraction of message lists to check")
+
+    parser.add_option("--workers",
+                      dest="workers", default=1, type="int",
+                      help="Number of worker processes to spread iterations over")
+
+    parser.add_option("--decision-workers",
+                      dest="decision_workers", default=1, type="int",
+                      help="Number of worker processes the agents of each run are spread over, to make their requests and uploads in parallel")
+
+    parser.add_option("--seed",
+                      dest="seed", default=None, type="int",
+                      help="Base random seed.  Each iteration derives its own seed from it")
+
+    parser.add_option("--cache-dir",
+                      dest="cache_dir", default=None,
+                      help="Keep finished runs here and reuse them when the config, seed and code are unchanged")
+
+    parser.add_option("--cache-size",
+                      dest="cache_size", default=1024, type="int",
+                      help="Size limit of --cache-dir in MB; least recently used runs go first")
+
+    parser.add_option("--timings",
+                      dest="timings", default=False, action="store_true",
+                      help="Time each phase of the round loop and print a table at the end (runs aren't taken from --cache-dir)")
+
+    parser.add_option("--timings-json",
+                      dest="timings_json", default=None,
+                      help="Write each round's phase times to this file, one JSON line per round")
+
+    parser.add_option("--latency",
+                      dest="latency", default=False, action="store_true",
+                      help="Time every requests() and uploads() call and print p50/p95/p99 per agent class and peer")
+
+    parser.add_option("--call-budget",
+                      dest="call_budget", default=None, type="float",
+                      help="Milliseconds an agent may take per requests() or uploads() call")
+
+    parser.add_option("--over-budget",
+                      dest="over_budget", default="flag",
+                      choices=["flag", "penalize"],
+                      help="What happens to a call over --call-budget: 'flag' (default) reports it, 'penalize' also drops its output for the round")
+
+    parser.add_option("--profile",
+                      dest="profile", default=None,
+                      help="Run under cProfile and write the stats to this file (slows agents down, so --latency and --call-budget see profiled times)")
+
+    return parser
+
+
+def default_options():
+    """The options sim.py runs with when given no flags"""
+    (options, args) = make_parser().parse_args([])
+    return options
+
+
+def make_config(agents_to_run, options):
+    """Build the sim's Params from a list of agent class names (see
+    parse_agents) and parsed options.  Loads the agent modules."""
+    config = Params()
+
+    config.add("agent_class_names", agents_to_run)
+    config.add("agent_classes", load_modules(config.agent_class_names))
+
+    config.add("num_pieces", options.num_pieces)
+    config.add("blocks_per_piece", options.blocks_per_piece)
+    config.add("max_round", options.max_round)
+    config.add("min_up_bw", options.min_up_bw)
+    config.add("max_up_bw", options.max_up_bw)
+    config.add("iters", options.iters)
+    config.add("ci_width", options.ci_width)
+    config.add("min_iters", options.min_iters)
+    config.add("max_iters", options.max_iters)
+    config.add("quiet", options.quiet)
+    config.add("engine", options.engine)
+    config.add("neighbors", options.neighbors)
+    config.add("neighbor_refresh", options.neighbor_refresh)
+    config.add("history_log", options.history_log)
+    config.add("validate", options.validate)
+    config.add("validate_fraction", options.validate_fraction)
+    config.add("workers", options.workers)
+    config.add("decision_workers", options.decision_workers)
+    config.add("seed", options.seed)
+    config.add("cache_dir", options.cache_dir)
+    config.add("cache_size", options.cache_size)
+    config.add("timings", options.timings)
+    config.add("timings_json", options.timings_json)
+    config.add("latency", options.latency)
+    config.add("call_budget", options.call_budget)
+    config.add("over_budget", options.over_budget)
+    return config
+
+
+def main(args):
+    parser = make_parser()
+
+    def usage(msg):
+        print(("Error: %s\n" % msg))
+        parser.print_help()
+        sys.exit()
+
     (options, args) = parser.parse_args()
 
     # leftover args are class names, with optional counts:
@@ -476,26 +953,44 @@ def main(args):
         except ValueError as e:
             usage(e)
 
+    if options.workers < 1:
+        usage("--workers must be at least 1")
+    if options.ci_width is not None and options.ci_width <= 0:
+        usage("--ci-width must be positive")
+    if options.min_iters < 2:
+        usage("--min-iters must be at least 2")
+    if options.decision_workers < 1:
+        usage("--decision-workers must be at least 1")
+    if options.neighbors < 0 or options.neighbor_refresh < 0:
+        usage("--neighbors and --neighbor-refresh can't be negative")
+    if options.workers > 1 and options.decision_workers > 1:
+        # Iteration workers can't start processes of their own
+        usage("Use --workers or --decision-workers, not both")
+
+    if options.quiet:
+        options.loglevel = "warning"
     configure_logging(options.loglevel)
-    config = Params()
+    if options.seed is None:
+        options.seed = random.randrange(2 ** 32)
+    logging.info("Base seed: %d" % options.seed)
 
-    config.add("agent_class_names", agents_to_run)
-    config.add("agent_classes", load_modules(config.agent_class_names))
-
-    config.add("num_pieces", options.num_pieces)
-    config.add("blocks_per_piece", options.blocks_per_piece)
-    config.add("max_round", options.max_round)
-    config.add("min_up_bw", options.min_up_bw)
-    config.add("max_up_bw", options.max_up_bw)
-    config.add("iters", options.iters)
+    config = make_config(agents_to_run, options)
 
     sim = Sim(config)
-    sim.run_sim()
+    if config.history_log:
+        # Runs are logged by seed, so rerunning with the same --seed would
+        # overwrite them
+        taken = [d for d in map(sim.history_log_dir, sim.iteration_seeds())
+                 if os.path.exists(d)]
+        if taken:
+            usage("--history-log %s already has runs with this --seed (%s); remove them or use another directory" % (
+                config.history_log, ", ".join(os.path.basename(d) for d in taken)))
+    if options.profile:
+        import cProfile
+        cProfile.runctx("sim.run_sim()", globals(), locals(), options.profile)
+    else:
+        sim.run_sim()
 
 
 if __name__ == "__main__":
-    # The next two lines are for profiling...
-    import cProfile
-
-    cProfile.run('main(sys.argv)', 'out.prof')
-#    main(sys.argv)
\ No newline at end of file
+    main(sys.argv)
@@ -0,0 +1,120 @@
+#!/usr/bin/python
+
+"""
+On-disk cache of single sim runs.  A run is keyed by a hash of
+
+  - the config values that change what happens (see RUN_CONTROL_KEYS for
+    the ones that don't),
+  - the run's random seed,
+  - the source of the sim's own modules and of each agent class's module.
+
+So editing one agent only invalidates the runs it took part in; editing
+the sim itself invalidates everything.  --validate isn't part of the key:
+only fully validated runs are stored, and those are the same whatever
+the setting.  Entries are pickled
+(History, summary) pairs, one file each.  When the cache grows past its
+size limit the least recently used entries are removed.
+"""
+
+import hashlib
+import importlib.util
+import json
+import os
+import pickle
+import sys
+import tempfile
+
+# Modules every run depends on
+CORE_MODULES = ["sim", "swarm", "history", "messages", "peer", "pieceset",
+                "stats", "tracker", "util"]
+
+# Config values that don't change a run's outcome
+RUN_CONTROL_KEYS = set(["agent_classes", "iters", "ci_width", "min_iters",
+                        "max_iters", "workers", "decision_workers", "seed",
+                        "quiet", "history_log", "validate",
+                        "validate_fraction", "engine", "cache_dir",
+                        "cache_size", "timings", "timings_json", "latency"])
+
+
+def module_file(name):
+    module = sys.modules.get(name)
+    path = getattr(module, "__file__", None)
+    if path is None:
+        spec = importlib.util.find_spec(name)
+        path = spec.origin
+    return path
+
+
+class RunCache:
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.source_hashes = dict()  # module name -> hash of its source
+        os.makedirs(path, exist_ok=True)
+
+    def source_hash(self, module_name):
+        h = self.source_hashes.get(module_name)
+        if h is None:
+            with open(module_file(module_name), "rb") as f:
+                h = hashlib.sha256(f.read()).hexdigest()
+            self.source_hashes[module_name] = h
+        return h
+
+    def key(self, conf, seed):
+        values = dict((k, v) for (k, v) in vars(conf).items()
+                      if not k.startswith("_") and k not in RUN_CONTROL_KEYS)
+        agent_modules = sorted(set(cls.__module__ for cls
+                                   in conf.agent_classes.values()))
+        sources = dict((m, self.source_hash(m))
+                       for m in CORE_MODULES + agent_modules)
+        s = json.dumps({"config": values, "seed": seed, "sources": sources},
+                       sort_keys=True)
+        return hashlib.sha256(s.encode("utf-8")).hexdigest()
+
+    def file(self, key):
+        return os.path.join(self.path, "%s.pkl" % key)
+
+    def get(self, key):
+        """The stored (history, summary), or None"""
+        path = self.file(key)
+        try:
+            with open(path, "rb") as f:
+                entry = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+        # Mark it as recently used
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return entry
+
+    def put(self, key, entry):
+        (fd, tmp) = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            pickle.dump(entry, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, self.file(key))
+        self.evict()
+
+    def evict(self):
+        """Remove least recently used entries until under max_bytes"""
+        entries = []
+        total = 0
+        for name in os.listdir(self.path):
+            if not name.endswith(".pkl"):
+                continue
+            try:
+                st = os.stat(os.path.join(self.path, name))
+            except OSError:
+                continue  # another process removed it
+            entries.append((st.st_mtime, st.st_size, name))
+            total += st.st_size
+        entries.sort()
+        for (mtime, size, name) in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.path, name))
+            except OSError:
+                pass
+            total -= size
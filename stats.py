@@ -10,13 +10,8 @@ class Stats:
         Returns:
         dict: peer_id -> total upload blocks used
         """
-        uploaded = dict((peer_id, 0) for peer_id in peer_ids)
-        for peer_id in peer_ids:
-            for ds in history.downloads[peer_id]:
-                for download in ds:
-                    uploaded[download.from_id] += download.blocks
-
-        return uploaded
+        totals = history.uploaded_blocks()
+        return dict((peer_id, totals.get(peer_id, 0)) for peer_id in peer_ids)
 
     @staticmethod
     def uploaded_blocks_str(peer_ids, history):
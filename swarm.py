@@ -0,0 +1,406 @@
+#!/usr/bin/python
+
+"""
+Swarm state engines: who has how many blocks of which piece, and what each
+round's uploads turn into.  The sim talks to the engine only through the
+SwarmState interface, so the storage behind it can be swapped:
+
+  - "dict":  the original representation, a list of block counts per peer
+             and a PieceSet (bitset) of available pieces per peer.
+  - "numpy": block counts in one peers x pieces integer array and available
+             pieces in a boolean matrix.  Agents get read-only views of
+             their rows.  A round's grants are worked out and applied with
+             array operations.  Needs numpy.
+
+Both engines produce the same Download records, in the same order.
+"""
+
+import itertools
+from collections.abc import Sequence
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from messages import Download
+from pieceset import PieceSet
+
+
+ENGINES = ["dict", "numpy"]
+
+
+def make_swarm_state(conf, peer_ids):
+    """Build the engine named by conf.engine"""
+    if conf.engine == "dict":
+        return SwarmState(conf, peer_ids)
+    elif conf.engine == "numpy":
+        return ArraySwarmState(conf, peer_ids)
+    raise ValueError("Unknown engine: %s" % conf.engine)
+
+
+def upload_rate_table(uploads):
+    """
+    uploads: dict : peer_id -> [uploads] -- uploads for this round
+
+    Returns dict : (uploader_id, recipient_id) -> uploading rate in blocks
+    per time period.  Pairs that aren't uploading aren't in the table.
+    Several uploads from one peer to the same recipient add up: the sim
+    has already checked that their total is within the uploader's limit.
+    """
+    rates = dict()
+    for (uploader_id, ups) in uploads.items():
+        for u in ups:
+            key = (uploader_id, u.to_id)
+            rates[key] = rates.get(key, 0) + u.bw
+    return rates
+
+
+class PiecesView(Sequence):
+    """
+    Read-only view of one peer's block counts.  Given to agents instead of a
+    copy: the sim only changes the counts after every agent has decided for
+    the round, so the view never changes under an agent mid-decision.
+    Both engines hand agents one, so they see the same type either way;
+    slices are plain lists.
+    """
+    __slots__ = ("_pieces",)
+
+    def __init__(self, pieces):
+        self._pieces = pieces
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return list(self._pieces[i])
+        return self._pieces[i]
+
+    def __len__(self):
+        return len(self._pieces)
+
+    def __iter__(self):
+        return iter(self._pieces)
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __repr__(self):
+        return repr(list(self._pieces))
+
+
+class SwarmState:
+    """
+    available:     dict : peer_id -> PieceSet(finished / available pieces)
+    available_map: dict : peer_id -> bytearray, 1 for each available piece.
+                   The same pieces as available, for testing one at a
+                   time: `in` on a PieceSet shifts the whole int.
+    availability:  dict : piece_id -> number of peers that have it available.
+                   Only changes when a piece completes.
+    completed:     dict : peer_id -> number of finished pieces.  A peer is
+                   done when it reaches num_pieces; see newly_done().
+
+    Agents only ever see read-only views or copies: PiecesView for block
+    counts, and PieceSet copies (one int each, so cheap) for available pieces.
+    """
+    def __init__(self, conf, peer_ids):
+        self.conf = conf
+        self.peer_ids = peer_ids[:]
+        self.index = dict((pid, i) for (i, pid) in enumerate(self.peer_ids))
+        self.init_pieces()
+
+        self.available = dict((pid, PieceSet(self.available_pieces(pid)))
+                              for pid in self.peer_ids)
+        self.available_map = dict()
+        for pid in self.peer_ids:
+            self.available_map[pid] = m = bytearray(conf.num_pieces)
+            for piece_id in self.available[pid]:
+                m[piece_id] = 1
+        self.availability = dict((i, 0) for i in range(conf.num_pieces))
+        for pid in self.peer_ids:
+            for piece_id in self.available[pid]:
+                self.availability[piece_id] += 1
+
+        self.completed = dict((pid, len(self.available[pid]))
+                              for pid in self.peer_ids)
+        self.done_count = 0
+        self.just_done = []  # peers done since the last newly_done()
+        for pid in self.peer_ids:
+            if self.completed[pid] == conf.num_pieces:
+                self.peer_finished(pid)
+
+    @staticmethod
+    def initial_pieces(conf, peer_id):
+        """Seeds start with every block, everyone else with none"""
+        if peer_id.startswith("Seed"):
+            return [conf.blocks_per_piece] * conf.num_pieces
+        else:
+            return [0] * conf.num_pieces
+
+    def init_pieces(self):
+        # dict : peer_id -> list (blocks / piece)
+        self.peer_pieces = dict((pid, self.initial_pieces(self.conf, pid))
+                                for pid in self.peer_ids)
+
+    def pieces(self, peer_id):
+        """The block counts of peer_id, safe to give to an agent"""
+        return PiecesView(self.peer_pieces[peer_id])
+
+    def blocks(self, peer_id, piece_id):
+        return self.peer_pieces[peer_id][piece_id]
+
+    def available_pieces(self, peer_id):
+        """
+        Return a list of piece ids that this peer has available.
+        """
+        conf = self.conf
+        return [i for i in range(conf.num_pieces)
+                if self.blocks(peer_id, i) >= conf.blocks_per_piece]
+
+    def completed_pieces(self, peer_id):
+        return self.completed[peer_id]
+
+    def peer_done(self, peer_id):
+        return self.completed[peer_id] == self.conf.num_pieces
+
+    def all_done(self):
+        return self.done_count == len(self.peer_ids)
+
+    def peer_finished(self, peer_id):
+        self.done_count += 1
+        self.just_done.append(peer_id)
+
+    def newly_done(self):
+        """Peers that got their last piece since the previous call (or
+        started with every piece), in peer_ids order"""
+        done = sorted(self.just_done, key=self.index.__getitem__)
+        self.just_done = []
+        return done
+
+    def available_view(self, peer_id):
+        """A snapshot of the available pieces of peer_id, for agents"""
+        return self.available[peer_id].copy()
+
+    def mark_available(self, peer_id, piece_id):
+        """peer_id just finished piece_id"""
+        self.available[peer_id].add(piece_id)
+        self.available_map[peer_id][piece_id] = 1
+        self.availability[piece_id] += 1
+        self.completed[peer_id] += 1
+        if self.completed[peer_id] == self.conf.num_pieces:
+            self.peer_finished(peer_id)
+
+    def apply_round(self, requests, rates):
+        """
+        rates: (uploader_id, recipient_id) -> bw, see upload_rate_table
+
+        Process the uploads: figure out how many blocks of all the requested
+        pieces the requesters ended up with.
+        Make sure requesting the same thing from lots of peers doesn't
+        stack.
+        update the sets of available pieces, and the availability
+        counts, as needed.
+
+        Nothing changes until every grant has been worked out; then the
+        block increments are applied in place.
+
+        Returns dict : peer_id -> [downloads]
+        """
+        conf = self.conf
+        downloads = dict()  # peer_id -> [downloads]
+        increments = []  # (peer_id, piece_id, blocks)
+        for requester_id in requests:
+            downloads[requester_id] = list()
+        for requester_id in requests:
+            # Keep track of how many blocks of each piece this
+            # requester got.  piece -> (blocks, from_who)
+            new_blocks_per_piece = dict()
+
+            def update_count(piece_id, blocks, peer_id):
+                if piece_id in new_blocks_per_piece:
+                    old = new_blocks_per_piece[piece_id][0]
+                    if blocks > old:
+                        new_blocks_per_piece[piece_id] = (blocks, peer_id)
+                else:
+                    new_blocks_per_piece[piece_id] = (blocks, peer_id)
+
+            # Group the requests by peer that is being asked
+            get_peer_id = lambda r: r.peer_id
+            rs = sorted(requests[requester_id], key=get_peer_id)
+            for peer_id, rs_for_peer in itertools.groupby(rs, get_peer_id):
+                bw = rates.get((peer_id, requester_id), 0)
+                if bw == 0:
+                    continue
+                # This bandwidth gets applied in order to each piece requested
+                for r in rs_for_peer:
+                    needed_blocks = conf.blocks_per_piece - r.start
+                    alloced_bw = min(bw, needed_blocks)
+                    update_count(r.piece_id, alloced_bw, peer_id)
+                    bw -= alloced_bw
+                    if bw == 0:
+                        break
+            for piece_id in new_blocks_per_piece:
+                (blocks, peer_id) = new_blocks_per_piece[piece_id]
+                increments.append((requester_id, piece_id, blocks))
+                d = Download(peer_id, requester_id, piece_id, blocks)
+                downloads[requester_id].append(d)
+
+        for (requester_id, piece_id, blocks) in increments:
+            pieces = self.peer_pieces[requester_id]
+            before = pieces[piece_id]
+            pieces[piece_id] += blocks
+            # A piece is finished the round its count reaches
+            # blocks_per_piece, even if a request starting before the next
+            # needed block pushed it past
+            if before < conf.blocks_per_piece <= pieces[piece_id]:
+                self.mark_available(requester_id, piece_id)
+
+        return downloads
+
+
+class ArraySwarmState(SwarmState):
+    """
+    counts: int array, peers x pieces, blocks each peer has of each piece
+    have:   bool array, peers x pieces, which pieces each peer has available
+
+    Row i belongs to peer_ids[i].  The available sets and availability
+    counts of SwarmState are still kept, updated only for pieces that
+    complete, since agents see those.
+    """
+    def __init__(self, conf, peer_ids):
+        if np is None:
+            raise ImportError("The numpy engine needs numpy installed")
+        SwarmState.__init__(self, conf, peer_ids)
+        # Requests are grouped by uploader in peer id order, as in the
+        # dict engine.  rank[i] is the position of peer_ids[i] in that order.
+        self.rank = np.empty(len(peer_ids), dtype=np.int64)
+        for (r, pid) in enumerate(sorted(peer_ids)):
+            self.rank[self.index[pid]] = r
+
+    def init_pieces(self):
+        conf = self.conf
+        self.counts = np.array([self.initial_pieces(conf, pid)
+                                for pid in self.peer_ids], dtype=np.int64)
+        self.counts.shape = (len(self.peer_ids), conf.num_pieces)
+        self.have = self.counts >= conf.blocks_per_piece
+        # A read-only view of each peer's row, made once: counts is only
+        # ever updated in place, so they stay current.  The checks use
+        # them as memoryviews, which index to plain ints, much faster than
+        # numpy scalars one element at a time; agents get them wrapped in
+        # a PiecesView, as with the dict engine.
+        self.rows = []
+        for row in self.counts:
+            row = row.view()
+            row.flags.writeable = False
+            self.rows.append(memoryview(row))
+        self.views = [PiecesView(row) for row in self.rows]
+        self.id_array = np.array(self.peer_ids, dtype=object)
+
+    def pieces(self, peer_id):
+        return self.views[self.index[peer_id]]
+
+    def blocks(self, peer_id, piece_id):
+        return self.rows[self.index[peer_id]][piece_id]
+
+    def available_pieces(self, peer_id):
+        return np.flatnonzero(self.have[self.index[peer_id]]).tolist()
+
+    def request_columns(self, requests, rates):
+        """The round's requests that can get anything, as an int array with
+        columns (requester row, uploader row, piece, start, uploader's rate
+        to the requester), in requests order.
+
+        Only requests to a peer that is uploading to the requester can be
+        granted, and those are usually a small fraction of them, so the
+        rest are dropped before any per-request work."""
+        index = self.index
+        granters = dict()  # requester id -> ids of peers uploading to it
+        for (uploader_id, requester_id) in rates:
+            granters.setdefault(requester_id, set()).add(uploader_id)
+        rows = []
+        for (requester_id, gs) in granters.items():
+            rs = requests.get(requester_id)
+            if not rs:
+                continue
+            i = index[requester_id]
+            rows.extend((i, index[r.peer_id], r.piece_id, r.start,
+                         rates[(r.peer_id, requester_id)])
+                        for r in rs if r.peer_id in gs)
+        # Back in requests order: by requester row, then request order
+        columns = np.array(rows, dtype=np.int64).reshape(len(rows), 5)
+        return columns[np.argsort(columns[:, 0], kind="stable")]
+
+    def apply_round(self, requests, rates):
+        """
+        Same rules as SwarmState.apply_round, one array operation at a time:
+        each requester's requests are sorted by uploader, each uploader's
+        bandwidth is spent on them in order, and for every (requester, piece)
+        only the biggest grant counts (the first one on ties).
+        """
+        conf = self.conf
+        downloads = dict((pid, list()) for pid in requests)
+
+        columns = self.request_columns(requests, rates)
+        if len(columns) == 0:
+            return downloads
+        (req, upl, piece, start, bw) = columns.T
+        seq = np.arange(len(req))
+
+        # Sort by requester, then uploader id, then request order
+        order = np.lexsort((seq, self.rank[upl], req))
+        req, upl, piece, start, bw = (
+            req[order], upl[order], piece[order], start[order], bw[order])
+
+        # Blocks granted to each request: the uploader's bw minus what the
+        # earlier requests in the same (requester, uploader) group used up
+        needed = conf.blocks_per_piece - start
+        group_start = np.ones(len(req), dtype=bool)
+        group_start[1:] = (req[1:] != req[:-1]) | (upl[1:] != upl[:-1])
+        used = np.cumsum(needed) - needed
+        used -= np.maximum.accumulate(np.where(group_start, used, 0))
+        alloc = np.clip(bw - used, 0, needed)
+
+        granted = alloc > 0
+        pos = np.flatnonzero(granted)
+        req, upl, piece, alloc = (
+            req[granted], upl[granted], piece[granted], alloc[granted])
+        if len(req) == 0:
+            return downloads
+
+        # Within each (requester, piece): biggest grant first, earliest on ties
+        order = np.lexsort((pos, -alloc, piece, req))
+        req, upl, piece, alloc, pos = (
+            req[order], upl[order], piece[order], alloc[order], pos[order])
+        first = np.ones(len(req), dtype=bool)
+        first[1:] = (req[1:] != req[:-1]) | (piece[1:] != piece[:-1])
+        starts = np.flatnonzero(first)
+        # Downloads are listed in the order each piece was first granted.
+        # pos follows the requester-sorted order, so each requester's
+        # downloads stay together.
+        seen = np.minimum.reduceat(pos, starts)
+        req, upl, piece, alloc = (
+            req[starts], upl[starts], piece[starts], alloc[starts])
+        order = np.argsort(seen, kind="stable")
+        req, upl, piece, alloc = (
+            req[order], upl[order], piece[order], alloc[order])
+
+        # One grant per (requester, piece) now, so no index repeats
+        before = self.counts[req, piece]
+        after = before + alloc
+        self.counts[req, piece] = after
+        done = np.flatnonzero((before < conf.blocks_per_piece) &
+                              (after >= conf.blocks_per_piece))
+        self.have[req[done], piece[done]] = True
+
+        ids = self.peer_ids
+        to_ids = self.id_array[req].tolist()
+        made = list(map(Download, self.id_array[upl].tolist(), to_ids,
+                        piece.tolist(), alloc.tolist()))
+        bounds = np.flatnonzero(req[1:] != req[:-1]) + 1
+        lo = 0
+        for hi in bounds.tolist() + [len(made)]:
+            downloads[to_ids[lo]] = made[lo:hi]
+            lo = hi
+
+        for (i, p) in zip(req[done].tolist(), piece[done].tolist()):
+            self.mark_available(ids[i], p)
+
+        return downloads
@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+
+"""
+Runs the sim over a grid (or list) of configurations and keeps every
+result in a local store, so an interrupted sweep picks up where it left off.
+
+A sweep is described by a JSON file:
+
+  {
+    "grid": {                               # every combination of these
+      "num_pieces": [20, 40],
+      "blocks_per_piece": [4],
+      "min_up_bw": [4],
+      "max_up_bw": [10, 20],
+      "max_round": [200],
+      "agents": ["MaxncodyStd,3 Seed,2", "MaxncodyTyrant,3 Seed,2"]
+    },
+    "runs": [                               # and/or explicit cells
+      {"num_pieces": 100, "agents": "MaxncodyTourney,5 Seed"}
+    ],
+    "iters": 10,
+    "seed": 1
+  }
+
+Any setting left out of a cell takes sim.py's default.  "agents" uses the
+sim.py command line syntax.  Iteration i of a cell uses the same seed as
+`sim.py --seed SEED --iters ITERS`, so a cell can be rerun by hand.
+
+Each (cell, seed) result is a JSON file in the store, named by a hash of
+both.  Runs whose file already exists are skipped.
+"""
+
+import hashlib
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import tempfile
+from optparse import OptionParser
+
+from sim import Sim, configure_logging, default_options, make_config, parse_agents
+from util import derive_seed, mean
+
+# Settings a cell can have, and their types
+CELL_KEYS = {
+    "num_pieces": int,
+    "blocks_per_piece": int,
+    "min_up_bw": int,
+    "max_up_bw": int,
+    "max_round": int,
+    "neighbors": int,
+    "neighbor_refresh": int,
+    "agents": str,
+}
+
+
+def expand(spec):
+    """Return the list of cells (dicts of CELL_KEYS) a sweep spec describes"""
+    cells = []
+    grid = spec.get("grid")
+    if grid:
+        keys = sorted(grid)
+        for values in itertools.product(*[grid[k] for k in keys]):
+            cells.append(dict(zip(keys, values)))
+    cells.extend(spec.get("runs", []))
+
+    for cell in cells:
+        for k in cell:
+            if k not in CELL_KEYS:
+                raise ValueError("Unknown sweep setting: %s" % k)
+            cell[k] = CELL_KEYS[k](cell[k])
+        if "agents" not in cell:
+            raise ValueError("Sweep cell has no agents: %s" % cell)
+    return cells
+
+
+def cell_options(cell, engine):
+    """sim.py options for a cell"""
+    options = default_options()
+    for (k, v) in cell.items():
+        if k != "agents":
+            setattr(options, k, v)
+    options.engine = engine
+    options.quiet = True
+    return options
+
+
+def result_key(cell, seed):
+    s = json.dumps({"cell": cell, "seed": seed}, sort_keys=True)
+    return hashlib.sha256(s.encode("utf-8")).hexdigest()[:32]
+
+
+class ResultStore:
+    """A directory of JSON result files, one per (cell, seed)"""
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def file(self, key):
+        return os.path.join(self.path, "%s.json" % key)
+
+    def has(self, key):
+        return os.path.exists(self.file(key))
+
+    def get(self, key):
+        with open(self.file(key)) as f:
+            return json.load(f)
+
+    def put(self, key, record):
+        # Write to a temp file and rename it into place, so a crash never
+        # leaves a half-written result that would be taken as done
+        (fd, tmp) = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump(record, f, sort_keys=True)
+        os.replace(tmp, self.file(key))
+
+
+def run_job(job):
+    """Run one (cell, seed) and store it.  Runs in a worker process."""
+    (cell, seed, engine, store_path) = job
+    config = make_config(parse_agents(cell["agents"].split()),
+                         cell_options(cell, engine))
+    sim = Sim(config)
+    (uploaded, completion) = sim.run_iteration(seed)
+    record = dict(cell=cell, seed=seed, peer_ids=sim.peer_ids,
+                  uploaded_blocks=uploaded, completion_rounds=completion)
+    ResultStore(store_path).put(result_key(cell, seed), record)
+    return result_key(cell, seed)
+
+
+def run_sweep(cells, iters, seed, store_path, workers=1, engine="dict"):
+    """Run every (cell, iteration) not already in the store.  Returns the
+    number of runs done."""
+    store = ResultStore(store_path)
+    seeds = [derive_seed(seed, "iter", i) for i in range(iters)]
+    jobs = [(cell, s, engine, store_path)
+            for cell in cells for s in seeds
+            if not store.has(result_key(cell, s))]
+    logging.warning("%d runs, %d already done, %d to go" % (
+        len(cells) * iters, len(cells) * iters - len(jobs), len(jobs)))
+
+    if workers > 1 and len(jobs) > 1:
+        pool = multiprocessing.Pool(workers)
+        try:
+            for (i, key) in enumerate(pool.imap_unordered(run_job, jobs)):
+                logging.info("Done %d/%d: %s" % (i + 1, len(jobs), key))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for (i, job) in enumerate(jobs):
+            key = run_job(job)
+            logging.info("Done %d/%d: %s" % (i + 1, len(jobs), key))
+    return len(jobs)
+
+
+def summarize(cells, iters, seed, store_path):
+    """Log, for each cell, mean completion round and uploaded blocks per
+    agent class over its iterations"""
+    store = ResultStore(store_path)
+    seeds = [derive_seed(seed, "iter", i) for i in range(iters)]
+    for cell in cells:
+        records = [store.get(result_key(cell, s)) for s in seeds]
+        logging.warning("==== %s" % json.dumps(cell, sort_keys=True))
+        by_class = dict()  # class name -> ([uploaded], [completion rounds])
+        for record in records:
+            names = parse_agents(cell["agents"].split())
+            for (name, pid) in zip(names, record["peer_ids"]):
+                (ups, rounds) = by_class.setdefault(name, ([], []))
+                ups.append(record["uploaded_blocks"][pid])
+                rounds.append(record["completion_rounds"][pid])
+        for (name, (ups, rounds)) in sorted(by_class.items()):
+            done = [r for r in rounds if r is not None]
+            logging.warning("%s: uploaded %.1f, completion round %s (%d/%d done)" % (
+                name, mean(ups), "%.1f" % mean(done) if done else "-",
+                len(done), len(rounds)))
+
+
+def main(args):
+    usage_msg = "Usage:  %prog [options] SWEEP.json"
+    parser = OptionParser(usage=usage_msg)
+
+    parser.add_option("--store",
+                      dest="store", default="sweep-results",
+                      help="Directory holding the results")
+
+    parser.add_option("--workers",
+                      dest="workers", default=1, type="int",
+                      help="Number of worker processes")
+
+    parser.add_option("--iters",
+                      dest="iters", default=None, type="int",
+                      help="Iterations per cell (overrides the sweep file)")
+
+    parser.add_option("--seed",
+                      dest="seed", default=None, type="int",
+                      help="Base seed (overrides the sweep file)")
+
+    parser.add_option("--engine",
+                      dest="engine", default="dict",
+                      help="Swarm state engine, as for sim.py")
+
+    parser.add_option("--loglevel",
+                      dest="loglevel", default="warning",
+                      help="Set the logging level: 'info' logs every finished run")
+
+    (options, args) = parser.parse_args(args[1:])
+    if len(args) != 1:
+        parser.print_help()
+        sys.exit(1)
+
+    with open(args[0]) as f:
+        spec = json.load(f)
+    iters = options.iters or spec.get("iters", 1)
+    seed = options.seed if options.seed is not None else spec.get("seed", 0)
+    cells = expand(spec)
+
+    configure_logging(options.loglevel)
+    run_sweep(cells, iters, seed, options.store, options.workers, options.engine)
+    summarize(cells, iters, seed, options.store)
+
+
+if __name__ == "__main__":
+    main(sys.argv)
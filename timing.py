@@ -0,0 +1,99 @@
+#!/usr/bin/python
+
+"""
+Where a sim run's time goes.  Sim.run_sim_once takes an optional timer and
+charges each phase of each round to it:
+
+  neighbors       with a tracker, its refreshes and indexing the peer info
+  requests        agents' requests(), and handing them their inputs
+  check_requests  validating the requests
+  uploads         agents' uploads()
+  check_uploads   validating the uploads
+  apply_round     working out and applying the round's downloads
+  history         History.update
+  logging         per-round logging
+  done_check      noting which peers are done
+"""
+
+import json
+import time
+
+PHASES = ["neighbors", "requests", "check_requests", "uploads",
+          "check_uploads", "apply_round", "history", "logging", "done_check"]
+
+
+class PhaseTimer:
+    """
+    Adds up the time spent in each phase of a run.  Call round() when a
+    round starts, then lap(phase) as each phase ends: the time since the
+    last lap (or the round start) is charged to that phase.  end_round()
+    adds the round's times to the run's totals and, with keep_rounds, keeps
+    them in by_round.
+    """
+    def __init__(self, keep_rounds=False):
+        self.totals = dict()  # phase -> seconds
+        self.rounds = 0
+        self.runs = 1
+        self.by_round = [] if keep_rounds else None
+        self.current = dict()  # phase -> seconds, this round
+        self.last = None
+
+    def round(self):
+        self.rounds += 1
+        self.current = dict()
+        self.last = time.perf_counter()
+
+    def lap(self, phase):
+        now = time.perf_counter()
+        self.current[phase] = self.current.get(phase, 0.0) + (now - self.last)
+        self.last = now
+
+    def end_round(self):
+        for (phase, t) in self.current.items():
+            self.totals[phase] = self.totals.get(phase, 0.0) + t
+        if self.by_round is not None:
+            self.by_round.append(self.current)
+
+    def total(self):
+        return sum(self.totals.values())
+
+    def merge(self, other):
+        """Add another run's totals to this one's"""
+        for (phase, t) in other.totals.items():
+            self.totals[phase] = self.totals.get(phase, 0.0) + t
+        self.rounds += other.rounds
+        self.runs += other.runs
+
+    def write_rounds(self, f, **fields):
+        """Write one JSON line per kept round to file f: the round number,
+        the seconds for each phase, and any extra fields given"""
+        for (r, phases) in enumerate(self.by_round):
+            line = dict(fields, round=r)
+            line.update(phases)
+            f.write(json.dumps(line, sort_keys=True) + "\n")
+
+    def table(self):
+        """The totals as a table of lines"""
+        total = self.total()
+        lines = ["%d run(s), %d rounds, %.3f s" % (self.runs, self.rounds, total),
+                 "%-16s %10s %7s %10s" % ("phase", "seconds", "%", "ms/round")]
+        phases = ([p for p in PHASES if p in self.totals] +
+                  sorted(p for p in self.totals if p not in PHASES))
+        for p in phases:
+            t = self.totals[p]
+            lines.append("%-16s %10.4f %7.1f %10.4f" % (
+                p, t, 100.0 * t / total if total else 0.0,
+                1000.0 * t / self.rounds if self.rounds else 0.0))
+        return lines
+
+
+class NullTimer:
+    """Times nothing.  What run_sim_once uses when not given a timer."""
+    def round(self):
+        pass
+
+    def lap(self, phase):
+        pass
+
+    def end_round(self):
+        pass
@@ -0,0 +1,70 @@
+#!/usr/bin/python
+
+"""
+A tracker that gives each peer a bounded set of neighbors, like a
+BitTorrent tracker handing out a random subset of the swarm.  With one,
+agents only see their neighbors' PeerInfo, and may only request from
+neighbors, so a round costs O(peers x degree) rather than O(peers^2).
+
+Neighbors are symmetric: if a is b's neighbor, b is a's, so a peer can
+always upload to whoever asked it for something.
+"""
+
+import random
+
+
+class Tracker:
+    def __init__(self, peer_ids, degree, refresh=0, rng=None):
+        """
+        degree: the most neighbors a peer gets.  Random pairing gives most
+            peers exactly degree, a few slightly fewer.
+        refresh: draw a new neighbor graph every this many rounds; 0 keeps
+            the first one for the whole run.
+        """
+        self.peer_ids = peer_ids[:]
+        self.index = dict((pid, i) for (i, pid) in enumerate(self.peer_ids))
+        self.degree = degree
+        self.refresh = refresh
+        self.rng = rng if rng is not None else random.Random()
+        self.neighbor_lists = None  # peer_id -> neighbor ids, in peers order
+        self.neighbor_sets = None   # peer_id -> set of neighbor ids
+        self.draw()
+
+    def draw(self):
+        """Pick a new random neighbor graph"""
+        adjacent = dict((pid, set()) for pid in self.peer_ids)
+        if self.degree >= len(self.peer_ids) - 1:
+            for pid in self.peer_ids:
+                adjacent[pid].update(self.peer_ids)
+                adjacent[pid].discard(pid)
+        else:
+            # Pair up degree "stubs" per peer at random, dropping the pairs
+            # that would be loops or repeats
+            stubs = [pid for pid in self.peer_ids for i in range(self.degree)]
+            self.rng.shuffle(stubs)
+            for (a, b) in zip(stubs[0::2], stubs[1::2]):
+                if a != b:
+                    adjacent[a].add(b)
+                    adjacent[b].add(a)
+
+        self.neighbor_sets = adjacent
+        self.neighbor_lists = dict(
+            (pid, sorted(adjacent[pid], key=self.index.__getitem__))
+            for pid in self.peer_ids)
+
+    def round(self, r):
+        """Called at the start of round r.  Returns True if the neighbors
+        changed (always for round 0)."""
+        if r == 0:
+            return True
+        if self.refresh and r % self.refresh == 0:
+            self.draw()
+            return True
+        return False
+
+    def neighbors(self, peer_id):
+        """peer_id's neighbors, in peers order"""
+        return self.neighbor_lists[peer_id]
+
+    def are_neighbors(self, a, b):
+        return b in self.neighbor_sets[a]
@@ -5,7 +5,9 @@
 # http://stackoverflow.com/questions/5098580/implementing-argmax-in-python
 
 from itertools import count
+import hashlib
 import math
+import random
 
 
 def argmax(pairs):
@@ -41,8 +43,7 @@ def stddev(lst):
     if len(lst) == 0:
         return 0
     m = mean(lst)
-    return math.sqrt(sum((x-m)*(x-m) for x in lst) // len(lst))
-
+    return math.sqrt(sum((x-m)*(x-m) for x in lst) / len(lst))
 
 def median(numeric):
     vals = sorted(numeric)
@@ -54,6 +55,73 @@ def median(numeric):
         upper = vals[count//2]
         return (float(lower + upper)) / 2
 
+def percentile(numeric, q):
+    """
+    The nearest-rank q-th quantile (0 < q <= 1) of a non-empty list.
+
+    >>> percentile([1, 2, 3, 4], 0.5)
+    2
+    >>> percentile([1, 2, 3, 4], 0.99)
+    4
+    """
+    vals = sorted(numeric)
+    rank = int(math.ceil(q * len(vals)))
+    return vals[min(max(rank, 1), len(vals)) - 1]
+
+
+def t_within(t, df):
+    """
+    P(|T| <= t) for Student's t with df (a positive int) degrees of
+    freedom, from the closed form for integer df (Abramowitz and Stegun
+    26.7.3-4).
+    """
+    theta = math.atan(t / math.sqrt(df))
+    c2 = math.cos(theta) ** 2
+    if df % 2 == 1:
+        (term, total, k) = (1.0, 0.0, 1)
+        if df > 1:
+            total = term = math.cos(theta)
+        while k + 2 < df:
+            term *= c2 * (k + 1) / float(k + 2)
+            total += term
+            k += 2
+        return 2 / math.pi * (theta + math.sin(theta) * total)
+    (term, total, k) = (1.0, 1.0, 0)
+    while k + 2 < df:
+        term *= c2 * (k + 1) / float(k + 2)
+        total += term
+        k += 2
+    return math.sin(theta) * total
+
+
+_t_critical = {}
+
+def t_critical(df, confidence=0.95):
+    """
+    The t such that P(|T| <= t) = confidence, for Student's t with df
+    degrees of freedom: the multiplier for a confidence interval on a mean
+    estimated from df+1 values.
+
+    >>> round(t_critical(1), 3)
+    12.706
+    >>> round(t_critical(9), 3)
+    2.262
+    >>> round(t_critical(1000), 3)
+    1.962
+    """
+    key = (df, confidence)
+    if key not in _t_critical:
+        (lo, hi) = (0.0, 1.0)
+        while t_within(hi, df) < confidence:
+            hi *= 2
+        for i in range(60):
+            mid = (lo + hi) / 2
+            if t_within(mid, df) < confidence:
+                lo = mid
+            else:
+                hi = mid
+        _t_critical[key] = hi
+    return _t_critical[key]
 
 
 def even_split(n, k):
@@ -86,6 +154,207 @@ def even_split(n, k):
     return ans
 
 
+class P2Quantile:
+    """
+    Streaming estimate of the q-th quantile of a stream of numbers, in
+    constant memory: the P-squared algorithm (Jain and Chlamtac, 1985).
+    Exact for the first five values.
+    """
+    def __init__(self, q):
+        self.q = q
+        self.first = []          # the first five values
+        self.heights = None      # marker heights
+        self.positions = None    # marker positions (1-based)
+        self.desired = None      # desired marker positions
+        self.increments = [0, q / 2.0, q, (1 + q) / 2.0, 1]
+
+    def add(self, x):
+        if self.heights is None:
+            self.first.append(x)
+            if len(self.first) == 5:
+                q = self.q
+                self.heights = sorted(self.first)
+                self.positions = [1, 2, 3, 4, 5]
+                self.desired = [1, 1 + 2 * q, 1 + 4 * q, 3 + 2 * q, 5]
+            return
+
+        h = self.heights
+        n = self.positions
+        # Find the cell x falls in, stretching the ends if need be
+        if x < h[0]:
+            h[0] = x
+            k = 0
+        elif x >= h[4]:
+            h[4] = x
+            k = 3
+        else:
+            k = 0
+            while x >= h[k + 1]:
+                k += 1
+        for i in range(k + 1, 5):
+            n[i] += 1
+        for i in range(5):
+            self.desired[i] += self.increments[i]
+
+        # Move the middle markers toward where they should be
+        for i in (1, 2, 3):
+            d = self.desired[i] - n[i]
+            if (d >= 1 and n[i + 1] - n[i] > 1) or (d <= -1 and n[i - 1] - n[i] < -1):
+                d = 1 if d > 0 else -1
+                # Piecewise-parabolic prediction, linear if that's out of order
+                p = h[i] + d / float(n[i + 1] - n[i - 1]) * (
+                    (n[i] - n[i - 1] + d) * (h[i + 1] - h[i]) / float(n[i + 1] - n[i]) +
+                    (n[i + 1] - n[i] - d) * (h[i] - h[i - 1]) / float(n[i] - n[i - 1]))
+                if not h[i - 1] < p < h[i + 1]:
+                    p = h[i] + d * (h[i + d] - h[i]) / float(n[i + d] - n[i])
+                h[i] = p
+                n[i] += d
+
+    def value(self):
+        """The estimate, or None if nothing was added"""
+        if self.heights is None:
+            if not self.first:
+                return None
+            return percentile(self.first, self.q)
+        return self.heights[2]
+
+
+class LogHistogram:
+    """
+    Counts of a stream of non-negative numbers in buckets whose bounds grow
+    by a fixed ratio, so each quantile is known to within that ratio (never
+    under the true value) in memory that grows only with the log of the
+    range of values.  Histograms merge exactly, and their quantiles never
+    decrease with q.  Values below smallest share the lowest bucket.
+
+    >>> h = LogHistogram()
+    >>> for x in range(1, 101):
+    ...     h.add(x)
+    >>> (h.n, h.max, h.quantile(1))
+    (100, 100, 100)
+    >>> 50 <= h.quantile(0.5) <= 50 * 2 ** (1 / 16.0)
+    True
+    """
+    def __init__(self, ratio=2 ** (1 / 16.0), smallest=1e-9):
+        self.log_ratio = math.log(ratio)
+        self.smallest = smallest
+        self.counts = dict()  # k -> count of values in (ratio^(k-1), ratio^k]
+        self.n = 0
+        self.max = None
+
+    def add(self, x):
+        k = int(math.ceil(math.log(max(x, self.smallest)) / self.log_ratio))
+        self.counts[k] = self.counts.get(k, 0) + 1
+        self.n += 1
+        if self.max is None or x > self.max:
+            self.max = x
+
+    def merge(self, other):
+        """Add other's counts, from a LogHistogram with the same ratio"""
+        for (k, c) in other.counts.items():
+            self.counts[k] = self.counts.get(k, 0) + c
+        self.n += other.n
+        if other.max is not None and (self.max is None or other.max > self.max):
+            self.max = other.max
+
+    def quantile(self, q):
+        """The nearest-rank q-th quantile (0 < q <= 1), rounded up to its
+        bucket's upper bound but no higher than the max"""
+        rank = max(int(math.ceil(q * self.n)), 1)
+        seen = 0
+        for k in sorted(self.counts):
+            seen += self.counts[k]
+            if seen >= rank:
+                return min(math.exp(k * self.log_ratio), self.max)
+        return self.max
+
+
+class RunningStats:
+    """
+    Count, mean, variance, min, max and quantiles of a stream of numbers,
+    updated one value at a time in constant memory: Welford's algorithm for
+    the variance, P2Quantile for the quantiles.  None values are counted
+    as missing and otherwise ignored.
+
+    >>> s = RunningStats()
+    >>> for x in [2, 4, 4, 4, 5, 5, 7, 9, None]:
+    ...     s.add(x)
+    >>> (s.n, s.missing, s.mean(), s.stddev(), s.min, s.max)
+    (8, 1, 5.0, 2.0, 2, 9)
+    """
+    QUANTILES = (0.5, 0.9)
+
+    def __init__(self, quantiles=QUANTILES):
+        self.n = 0
+        self.missing = 0
+        self.total = 0      # kept exactly, so the mean matches mean()
+        self.running_mean = 0.0
+        self.m2 = 0.0       # sum of squared differences from the mean
+        self.min = None
+        self.max = None
+        self.sketches = dict((q, P2Quantile(q)) for q in quantiles)
+
+    def add(self, x):
+        if x is None:
+            self.missing += 1
+            return
+        self.n += 1
+        self.total += x
+        delta = x - self.running_mean
+        self.running_mean += delta / float(self.n)
+        self.m2 += delta * (x - self.running_mean)
+        if self.min is None or x < self.min:
+            self.min = x
+        if self.max is None or x > self.max:
+            self.max = x
+        for sketch in self.sketches.values():
+            sketch.add(x)
+
+    def mean(self):
+        """Throws a div by zero exception if nothing was added, like mean()"""
+        return self.total / float(self.n)
+
+    def stddev(self):
+        """Population standard deviation, like stddev()"""
+        if self.n == 0:
+            return 0
+        return math.sqrt(self.m2 / self.n)
+
+    def ci_width(self, confidence=0.95):
+        """
+        Width of the confidence interval on the mean of the values so far,
+        from the sample standard deviation and Student's t with n-1
+        degrees of freedom.  Infinite for fewer than two values.
+        """
+        if self.n < 2:
+            return float("inf")
+        t = t_critical(self.n - 1, confidence)
+        return 2 * t * math.sqrt(self.m2 / (self.n - 1) / self.n)
+
+    def quantile(self, q):
+        return self.sketches[q].value()
+
+
+def derive_seed(seed, *keys):
+    """
+    Deterministically derive a new 64-bit seed from seed and any number of
+    extra keys (iteration number, peer id, ...).  The same inputs always give
+    the same seed, across processes and Python runs.
+    """
+    s = ":".join(str(k) for k in (seed,) + keys)
+    return int(hashlib.sha256(s.encode("utf-8")).hexdigest()[:16], 16)
+
+
+def seeded_rng(seed, *keys):
+    """
+    A random.Random seeded with derive_seed(seed, *keys), or an unseeded
+    one if seed is None.
+    """
+    if seed is None:
+        return random.Random()
+    return random.Random(derive_seed(seed, *keys))
+
+
 def load_modules(agent_classes):
     """Each agent class must be in module class_name.lower().
     Returns a dictionary class_name->class"""